@@ -0,0 +1,241 @@
+# Offline benchmark of convert.py: serves a generated html book from a local server and replaces gemini with a
+# deterministic stub, so throughput can be measured (and regressions caught) without network access or api costs
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+# convert.py refuses to load without an api key; the stub models below never use it
+os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+
+import PIL.Image
+
+import convert
+
+NAV_STYLES = ("anchor", "button", "rel")
+
+
+def generate_page(index, pages, paragraphs, images, nav_style, scroll_containers, toc):
+    """
+    Returns the html of page `index` of a generated book; page 0 is the home page
+    """
+    body = ["<header>Benchmark book</header>", f"<h1>Chapter {index}</h1>"]
+    if index == 0 and toc:
+        body.append("<ol>")
+        for chapter in range(1, pages):
+            body.append(f'<li><a href="/page/{chapter}">Chapter {chapter}</a></li>')
+        body.append("</ol>")
+    for container in range(scroll_containers):
+        body.append(
+            '<div style="overflow-y: scroll; height: 200px">'
+            + f"<p>Scroll container {container} of chapter {index}.</p>" * 20
+            + "</div>"
+        )
+    for paragraph in range(paragraphs):
+        body.append(
+            f"<p>Chapter {index}, paragraph {paragraph}. "
+            + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8
+            + "</p>"
+        )
+    for image in range(images):
+        body.append(f'<img src="/image/{index}/{image}.png" width="400" height="300">')
+    if index > 0:
+        body.append(f'<a href="/page/{index - 1}" class="previous-page">Previous</a>')
+    if index < pages - 1:
+        if nav_style == "button":
+            body.append(
+                f"<button class=\"next-page\" onclick=\"location.href='/page/{index + 1}'\">Next</button>"
+            )
+        elif nav_style == "rel":
+            body.append(f'<a href="/page/{index + 1}" rel="next">Continue</a>')
+        else:
+            body.append(f'<a href="/page/{index + 1}" class="next-page">Next</a>')
+    body.append("<footer>Generated for benchmarking</footer>")
+    head = ""
+    if nav_style == "rel" and index < pages - 1:
+        head = f'<link rel="next" href="/page/{index + 1}">'
+    return (
+        f"<!DOCTYPE html><html><head><title>Chapter {index}</title>{head}</head>"
+        f"<body>{''.join(body)}</body></html>"
+    )
+
+
+def generate_image(seed):
+    """
+    Returns a png that differs per seed, so the browser can't reuse one image for every page
+    """
+    image = PIL.Image.new("RGB", (400, 300), ((seed * 37) % 256, (seed * 91) % 256, 128))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def serve_book(pages, paragraphs, images, nav_style, scroll_containers, toc):
+    """
+    Serves a generated book on a free local port and returns the server; its home page is at /page/0
+    """
+
+    class BookHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            page = re.fullmatch(r"/page/(\d+)", self.path)
+            image = re.fullmatch(r"/image/(\d+)/(\d+)\.png", self.path)
+            if page and int(page.group(1)) < pages:
+                body = generate_page(
+                    int(page.group(1)),
+                    pages,
+                    paragraphs,
+                    images,
+                    nav_style,
+                    scroll_containers,
+                    toc,
+                ).encode()
+                content_type = "text/html; charset=utf-8"
+            elif image:
+                body = generate_image(int(image.group(1)) * 100 + int(image.group(2)))
+                content_type = "image/png"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StubModel:
+    """
+    Deterministic stand-in for a gemini model: picks the "Next" candidate, confirms tables of contents as they are
+    and records the size of every prompt it receives
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.prompt_bytes = []
+
+    def generate_content(self, contents):
+        self.prompt_bytes.append(
+            sum(
+                len(part.encode()) if isinstance(part, str) else len(part["data"])
+                for part in contents
+            )
+        )
+        prompt = contents[0]
+        if "### NAVIGATION CANDIDATES\n" in prompt:
+            text = json.dumps(self.next_page(prompt))
+        elif "### EXTRACTED PAGES\n" in prompt:
+            listing = prompt.split("### EXTRACTED PAGES\n", 1)[1]
+            text = json.dumps(
+                {"order": list(range(len(listing.splitlines()))), "log": "stub"}
+            )
+        else:
+            text = "1. Benchmark book"
+        return SimpleNamespace(text=text, usage_metadata=None)
+
+    def next_page(self, prompt):
+        candidates = json.loads(prompt.split("### NAVIGATION CANDIDATES\n", 1)[1])
+        for candidate in candidates:
+            if candidate["rel"] == "next" or candidate["text"] in ("Next", "Continue"):
+                return dict(candidate, candidate=candidate["index"], log="stub")
+        return {
+            key: "NONE"
+            for key in ("candidate", "tag", "href", "text", "class", "id", "log")
+        }
+
+
+def run(args):
+    """
+    Converts a generated book with stub models and returns the benchmark report
+    """
+    server = serve_book(
+        args.pages,
+        args.paragraphs,
+        args.images,
+        args.nav_style,
+        args.scroll_containers,
+        args.toc,
+    )
+    models = {
+        name: StubModel(getattr(convert, name).model_name)
+        for name in ("gemini", "table_of_contents_ai", "toc_links_ai")
+    }
+    for name, model in models.items():
+        setattr(convert, name, model)
+    # The stub answers instantly; cached answers from earlier runs would only skew the prompt counts
+    convert.scheduler.cache = None
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix="htmlbooktopdf-benchmark-")
+    os.makedirs(output_dir, exist_ok=True)
+    url = f"http://127.0.0.1:{server.server_address[1]}/page/0"
+    # Stage timings come from the run report convert.py keeps anyway; no event log is needed here
+    report = convert.RunReport()
+    start = time.perf_counter()
+    try:
+        output = convert.convert(
+            url,
+            output_dir,
+            "benchmark",
+            workers=args.workers,
+            navigation=args.navigation,
+            confirm=False,
+            report=report,
+        )
+    finally:
+        server.shutdown()
+    elapsed = time.perf_counter() - start
+    prompts = [size for model in models.values() for size in model.prompt_bytes]
+    return {
+        "pages": args.pages,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(args.pages / elapsed, 3),
+        "stages": report.summary(),
+        "llm_calls": len(prompts),
+        "prompt_bytes_per_page": round(sum(prompts) / args.pages),
+        # ru_maxrss is in kilobytes on linux; the browser counts once its processes have been reaped
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_browser_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+        ),
+        "output_bytes": os.path.getsize(output),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks convert.py offline on a generated book with a stub gemini"
+    )
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--paragraphs", type=int, default=20, help="paragraphs per page")
+    parser.add_argument("--images", type=int, default=1, help="images per page")
+    parser.add_argument("--nav-style", choices=NAV_STYLES, default="anchor")
+    parser.add_argument(
+        "--scroll-containers", type=int, default=2, help="scrollable divs per page"
+    )
+    parser.add_argument(
+        "--toc", action="store_true", help="link every page from the home page"
+    )
+    parser.add_argument("--workers", type=int, default=convert.WORKERS)
+    parser.add_argument(
+        "--navigation", choices=["auto", "toc", "llm"], default="llm"
+    )
+    parser.add_argument("--output-dir", help="defaults to a temporary directory")
+    parser.add_argument("--report", help="also write the report to this json file")
+    args = parser.parse_args()
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(report, file, indent=2)
@@ -1,29 +1,47 @@
 # A Command Line utility for taking html books like https://artint.info/3e/html/ArtInt3e.html and converting them to pdfs
 # This is a quick and dirty tool; no guarantees about quality are made, so use at your own discretion
+import argparse
 import base64
+import contextlib
+import cProfile
+import hashlib
+import inspect
+import io
 import json
-import sys
+import math
 import time
-from pypdf import PdfWriter
+from pypdf import PdfReader, PdfWriter
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.wait import WebDriverWait
-from selenium.webdriver.support.expected_conditions import staleness_of
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.common.exceptions import (
     NoSuchElementException,
+    SessionNotCreatedException,
     StaleElementReferenceException,
-    TimeoutException,
 )
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.webdriver.support import expected_conditions as EC
 from dotenv import load_dotenv
 import os
+import pstats
+import random
+import re
+import sys
+import threading
+from urllib.parse import urldefrag, urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
 import PIL.Image
 
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl, cache directories are only kept apart within this process
+    fcntl = None
+
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GEMINI_API_KEY is None:
@@ -121,39 +139,41 @@ This system helps convert HTML books to PDF by identifying elements that link to
 You will be provided with:
 
 * A table of contents of the book
-* A list of the urls for previously visited pages (empty on the first page).
-* A list of features of the previous page elements that led to the current page (empty on the first page).
-* Screenshots and corresponding HTML of the current page of the book.
+* A summary of your progress: the number of pages visited, the title of the current page and the most recently visited pages.
+* The distinct features of the elements that led to the last few pages, each with the number of pages it led to (empty on the first page).
+* A screenshot of the current page of the book and a numbered list of its navigation candidates (links and buttons).
 
 Note that the first prompt in the series will include the home page (likely the table of contents). Make sure to use this to verify that you visit all of the sections of the book!
 
-Your task is to analyze the HTML and screenshot to identify the element that leads to the next page in the book.
+Your task is to analyze the navigation candidates and screenshot to identify the candidate that leads to the next page in the book.
 
 ## Expected Output
 
 Return a JSON object with features of the element to click, for example:
 
 {
+  "candidate": 3,  // Index of the chosen navigation candidate
   "tag": "a",  // Anchor tag
   "href": "chapter2",  // Link on the tag to the next page
   "text": "Next Chapter",  // Minimum text of the tag necessary for matching
   "class": "next-page",  // Classes of the tag
-  "id": "NONE"  // Placeholder (if not provided in HTML)
-  "log": "'a' tag found in the HTML as well as at the top left of the screen. Text is Next, class is next-page, and it seems tro take you to the next chapter with href='chapter2'" // A log explaining your reasoning for the features
+  "id": "NONE"  // Placeholder (if not provided in the candidate)
+  "log": "'a' tag found in the candidates as well as at the top left of the screen. Text is Next, class is next-page, and it seems tro take you to the next chapter with href='chapter2'" // A log explaining your reasoning for the features
 }
 
 ## Important Rules
 
 * Avoid revisiting pages; we're trying to create a book, so proper page order is CRUCIAL.
-* Return "NONE" if the extracted link (e.g., href attribute) is ALREADY PRESENT in the visited pages list. You can compare the href for the tag to the urls in the previously visited list to avoid revisiting pages.
-* DO NOT return 'NONE' unless you have viewed ALL POSSIBLE SECTIONS IN THE TABLE OF CONTENTS and ALL POSSIBLE PAGES WITHIN THEM.
+* Candidates leading to pages that were already visited have been removed from the list; if the next page is not among the candidates, choose the candidate closest to the next unvisited section in the table of contents (for example its chapter, or the table of contents itself).
+* Returning 'NONE' ends the book. DO NOT return 'NONE' unless you have viewed ALL POSSIBLE SECTIONS IN THE TABLE OF CONTENTS and ALL POSSIBLE PAGES WITHIN THEM.
     * Note that the table of contents may not be exhaustive (for example it may not contain subsections), but it should be the MINIMUM number of pages you view 
-* Extract features ("tag", "href", "text", "class", "id") directly from the provided HTML.
+* Return the "index" of the chosen candidate as "candidate"; ONLY choose from the provided candidates.
+* Copy features ("tag", "href", "text", "class", "id") directly from the chosen candidate.
 * When selecting text, most books use tags such as "a" or "link", so you should generally prioritize these
-* Include EXACTLY the "text" that you see in the HTML + screenshot to ensure accurate matching. This means including characters like SPACES and PARENTHESIS.
+* Include EXACTLY the "text" that you see in the candidate + screenshot to ensure accurate matching. This means including characters like SPACES and PARENTHESIS.
 * Do NOT include any escape characters such as "\n" or "\t" in the text.
 * Do not combine classes of multiple elements or include uncertain information.
-* Verify the consistency of ALL FEATURES using the provided HTML.
+* Verify the consistency of ALL FEATURES using the provided candidates.
 
 ## Goal
 
@@ -161,7 +181,7 @@ Provide general features to consistently identify next page elements throughout
 
 ## Completion
 
-Once the entire HTML has been processed, return "NONE" for all features to indicate the end of the book conversion.
+Once the entire book has been processed, return "NONE" for all features to indicate the end of the book conversion.
 
 ## User Input (Sample)
 
@@ -173,26 +193,23 @@ Once the entire HTML has been processed, return "NONE" for all features to indic
 4. Chapter Four
 5. Chapter Five
 
-### VISITED PAGES
+### PROGRESS
 
-[]
+1 pages visited so far; the current page is 'Chapter 1: Introduction' (https://example.com/book/chapter1).
+0 candidates leading to visited pages were removed.
+Most recently visited pages:
+* NONE
 
 ### PREVIOUS FEATURES
 
 []
 
-### CURRENT HTML
-
-<!DOCTYPE html>
-<html>
-<body>
-
-<h1>Chapter 1: Introduction</h1>
-<p>This is the first chapter of the book.</p>
-<a href="chapter2" class="next-page">Next Chapter</a>
+### NAVIGATION CANDIDATES
 
-</body>
-</html>
+[
+  {"index": 0, "tag": "a", "href": "index", "text": "Home", "class": "NONE", "id": "NONE", "rel": "NONE", "context": "nav.top"},
+  {"index": 3, "tag": "a", "href": "chapter2", "text": "Next Chapter", "class": "next-page", "id": "NONE", "rel": "next", "context": "div.footer < main"}
+]
 
 ### Screenshot 
 
@@ -201,17 +218,19 @@ Once the entire HTML has been processed, return "NONE" for all features to indic
 ### System Response
 
 {
+  "candidate": 3,
   "tag": "a",
   "href": "chapter2",
   "text": "Next",
   "class": "next-page",
   "id": "NONE",
-  "log": "'a' tag found in the HTML as well as at the top left of the screen. Text is Next, class is next-page, and it seems tro take you to the next chapter with href='chapter2'"
+  "log": "'a' tag found in the candidates as well as at the top left of the screen. Text is Next, class is next-page, and it seems tro take you to the next chapter with href='chapter2'"
 }
 
 ### SYSTEM RESPONSE (example on book complete)
 
 {
+  "candidate": "NONE",
   "tag": "NONE",
   "href": "NONE",
   "text": "NONE",
@@ -222,33 +241,1154 @@ Once the entire HTML has been processed, return "NONE" for all features to indic
 
 ## Logging and Debugging
 
-It's helpful to add your reasoning for the features extracted from the HTML or for returning "NONE". This will help improve the program and help you validate the decisions that you make.
+It's helpful to add your reasoning for the candidate chosen or for returning "NONE". This will help improve the program and help you validate the decisions that you make.
+"""
+TOC_LINKS_SYSTEM_PROMPT = """
+This system confirms the table of contents of an HTML book that was extracted from the links on its home page.
+
+You will be provided with a numbered list of the extracted pages, indented by their nesting in the table of contents, each with its link text and url.
+
+Your task is to check that the list contains the pages of the book in reading order.
+
+## Expected Output
+
+Return a JSON object with the numbers of the pages that belong to the book, in reading order, for example:
+
+{
+  "order": [0, 1, 2, 3, 5, 4],
+  "log": "Pages 4 and 5 were swapped; section 2.2 comes before section 2.3"  // A log explaining any changes
+}
+
+## Important Rules
+
+* Keep the list as it is when it is already correct; most extracted lists are.
+* Drop entries that are not part of the book's content (for example "Home", "Search", "About the author", errata or external indexes).
+* ONLY use numbers from the provided list and do not repeat a number.
+* Return ONLY the JSON object.
+"""
+
+# Number of consecutive pages that must be reached through matching features before navigation replays them as a rule
+RULE_THRESHOLD = 3
+# Features that have to agree for a rule to be learned
+RULE_FEATURES = ("tag", "text", "class", "id")
+
+# Style hiding elements that are likely unnecessary for retrieving the book's content
+FILTER_STYLE = """
+@page {
+    margin: 0 !important;
+    padding: 0 !important;
+}
+header, footer {
+    display: none !important;
+}
+"""
+# Requests for these url patterns (* matches anything) are blocked in every browser: ads, analytics, trackers, video
+# embeds and comment widgets, none of which are part of a book
+BLOCKED_URLS = (
+    "*google-analytics.com/*",
+    "*googletagmanager.com/*",
+    "*googlesyndication.com/*",
+    "*googleadservices.com/*",
+    "*doubleclick.net/*",
+    "*adservice.google.*",
+    "*amazon-adsystem.com/*",
+    "*connect.facebook.net/*",
+    "*scorecardresearch.com/*",
+    "*hotjar.com/*",
+    "*taboola.com/*",
+    "*outbrain.com/*",
+    "*disqus.com/*",
+    "*disquscdn.com/*",
+    "*youtube.com/embed/*",
+    "*youtube-nocookie.com/*",
+    "*player.vimeo.com/*",
+)
+# Resource types blocked in every browser, and the url patterns that block them (setBlockedURLs only matches urls)
+BLOCKED_RESOURCE_TYPES = ("media",)
+RESOURCE_TYPE_URLS = {
+    resource_type: tuple(
+        pattern
+        for extension in extensions
+        for pattern in (f"*.{extension}", f"*.{extension}?*")
+    )
+    for resource_type, extensions in {
+        "media": ("mp4", "webm", "m3u8", "mp3"),
+        "font": ("woff", "woff2", "ttf", "otf"),
+        "image": ("png", "jpg", "jpeg", "gif", "webp"),
+    }.items()
+}
+# Elements removed before printing: ad slots, embedded players and comment sections
+REMOVED_SELECTORS = (
+    "ins.adsbygoogle",
+    "[id^='google_ads']",
+    "[id^='div-gpt-ad']",
+    "iframe[src*='youtube']",
+    "iframe[src*='vimeo']",
+    "#disqus_thread",
+    "#comments",
+    ".comments",
+)
+# Prepares the page for printing in a single call: applies the filter style (arguments[0], if any), removes the
+# elements matching arguments[1] (if any), lets the body grow, unravels scrollable elements and returns the
+# dimensions of the body
+PREPARE_PAGE_SCRIPT = """
+if (arguments[0]) {
+    var style = document.createElement('style');
+    style.innerHTML = arguments[0];
+    document.head.appendChild(style);
+}
+var removed = 0;
+if (arguments[1]) {
+    document.querySelectorAll(arguments[1]).forEach(function (element) {
+        element.remove();
+        removed++;
+    });
+}
+var body = document.body;
+// Set the body to scroll and remove any properties that might constrain its height
+body.style.overflowY = 'scroll';
+body.style.height = 'auto';
+body.style.overflow = 'auto';
+var verticallyScrollable = document.querySelectorAll('[style*="overflow-y"]');
+var scrollable = document.querySelectorAll('[style*="overflow"]');
+var unscrolled = 0;
+scrollable.forEach(function (element) {
+    if (element === body) {
+        return;
+    }
+    element.style.overflowY = 'visible';
+    element.style.overflow = 'visible';
+    unscrolled++;
+});
+return {
+    width: body.scrollWidth,
+    height: body.scrollHeight,
+    unscrolled: unscrolled,
+    removed: removed,
+    vertically_scrollable: verticallyScrollable.length,
+    body_vertically_scrollable: Array.prototype.indexOf.call(verticallyScrollable, body) >= 0 ? 1 : 0,
+    scrollable: scrollable.length,
+    body_scrollable: Array.prototype.indexOf.call(scrollable, body) >= 0 ? 1 : 0
+};
+"""
+
+# Ceiling in seconds on waiting for a page to become ready before capturing it anyway
+READY_TIMEOUT = 10
+READY_POLL_INTERVAL = 0.1
+# Without a new document loading within this many seconds (same document navigations, or a page whose lifecycle
+# events were already read), a complete document is left to the in-page checks
+READY_LOAD_GRACE = 0.5
+# Resolves once the document has loaded, its fonts are ready, and MathJax and highlight.js (when the page uses them)
+# have finished, or when the ceiling (arguments[0] milliseconds) is reached
+READY_SCRIPT = """
+var done = arguments[arguments.length - 1];
+var deadline = Date.now() + arguments[0];
+function pending() {
+    var waiting = [];
+    if (document.readyState !== 'complete') {
+        waiting.push('document');
+    }
+    if (document.fonts && document.fonts.status !== 'loaded') {
+        waiting.push('fonts');
+    }
+    if (window.MathJax && window.__htmlbooktopdfMathJax !== true) {
+        // Hook into the typesetting queue once; the hook marks MathJax as done
+        if (!window.__htmlbooktopdfMathJax) {
+            var typeset = function () { window.__htmlbooktopdfMathJax = true; };
+            window.__htmlbooktopdfMathJax = 'pending';
+            if (MathJax.startup && MathJax.startup.promise) {
+                MathJax.startup.promise.then(typeset);
+            } else if (MathJax.Hub && MathJax.Hub.Queue) {
+                MathJax.Hub.Queue(typeset);
+            } else {
+                typeset();
+            }
+        }
+        if (window.__htmlbooktopdfMathJax !== true) {
+            waiting.push('MathJax');
+        }
+    }
+    // highlightAll highlights every block in one go, so highlighting is done once any block is highlighted; blocks
+    // opted out (or left for selective highlighting) are never waited for on their own
+    if (window.hljs && !document.querySelector('pre code.hljs')
+            && document.querySelector('pre code:not(.nohighlight):not(.no-highlight):not([class*="language-none"])')) {
+        waiting.push('highlight.js');
+    }
+    return waiting;
+}
+(function check() {
+    var waiting = pending();
+    if (!waiting.length || Date.now() >= deadline) {
+        done({ready: !waiting.length, pending: waiting.join(', ') || 'nothing pending'});
+    } else {
+        setTimeout(check, 50);
+    }
+})();
+"""
+
+# Screenshots sent to gemini cover at most a tile of this size from the top of the page
+SCREENSHOT_TILE_WIDTH = 1920
+SCREENSHOT_TILE_HEIGHT = 3840
+# The tile is downscaled to fit these dimensions and re-encoded until it fits in SCREENSHOT_MAX_BYTES
+SCREENSHOT_MAX_WIDTH = 1280
+SCREENSHOT_MAX_HEIGHT = 2560
+SCREENSHOT_MAX_BYTES = 400_000
+SCREENSHOT_FORMAT = "jpeg"
+SCREENSHOT_QUALITY = 85
+
+# Elements offered to gemini as possible links to the next page
+NAVIGATION_CANDIDATE_SELECTOR = "a[href], button, link[rel='next'], [role='button'], [role='link'], [onclick]"
+# Collects a compact description of every navigation candidate in a single round trip; a candidate's index is its
+# position in document.querySelectorAll(selector) so it can be looked up again after gemini picks it
+NAVIGATION_CANDIDATES_SCRIPT = """
+function describe(node) {
+    var description = node.tagName.toLowerCase();
+    if (node.id) {
+        description += '#' + node.id;
+    }
+    if (typeof node.className === 'string' && node.className.trim()) {
+        description += '.' + node.className.trim().split(/\\s+/).join('.');
+    }
+    return description;
+}
+var elements = document.querySelectorAll(arguments[0]);
+var candidates = [];
+var seen = {};
+for (var index = 0; index < elements.length; index++) {
+    var element = elements[index];
+    var text = (element.innerText || element.textContent || element.getAttribute('aria-label')
+        || element.getAttribute('title') || '').replace(/\\s+/g, ' ').trim().slice(0, 80);
+    var href = element.getAttribute('href') || 'NONE';
+    if (!text && href === 'NONE') {
+        continue;
+    }
+    var className = typeof element.className === 'string' && element.className.trim() ? element.className.trim() : 'NONE';
+    var key = [element.tagName, href, text, className].join('|');
+    // Books often repeat the same navigation bar above and below the content
+    if (seen[key]) {
+        continue;
+    }
+    seen[key] = true;
+    var context = [];
+    var parent = element.parentElement;
+    while (parent && parent !== document.body && context.length < 2) {
+        context.push(describe(parent));
+        parent = parent.parentElement;
+    }
+    candidates.push({
+        index: index,
+        tag: element.tagName.toLowerCase(),
+        href: href,
+        text: text || 'NONE',
+        class: className,
+        id: element.id || 'NONE',
+        rel: element.getAttribute('rel') || 'NONE',
+        context: context.join(' < ') || 'body',
+        url: element.href && typeof element.href === 'string' ? element.href : null
+    });
+}
+return {
+    candidates: candidates,
+    html_length: document.documentElement.outerHTML.length,
+    title: document.title,
+    url: window.location.href
+};
+"""
+
+# Minimum number of linked pages for the home page's link list to be used as the table of contents
+TOC_MIN_PAGES = 3
+# Returns the links of the largest list of same-origin links on the page (the table of contents of most html books)
+# in document order, with the depth of each link in the nested lists
+TOC_LINKS_SCRIPT = """
+function sameOriginLinks(list) {
+    return Array.from(list.querySelectorAll('a[href]')).filter(function (link) {
+        return link.origin === window.location.origin && link.protocol.indexOf('http') === 0;
+    });
+}
+var best = null;
+var bestLinks = [];
+document.querySelectorAll('ol, ul').forEach(function (list) {
+    // Only consider outermost lists; nested lists are part of their parent's tree
+    if (list.parentElement && list.parentElement.closest('ol, ul')) {
+        return;
+    }
+    var links = sameOriginLinks(list);
+    if (links.length > bestLinks.length) {
+        best = list;
+        bestLinks = links;
+    }
+});
+return bestLinks.map(function (link) {
+    var depth = 0;
+    var parent = link.parentElement;
+    while (parent && parent !== best) {
+        if (parent.tagName === 'OL' || parent.tagName === 'UL') {
+            depth++;
+        }
+        parent = parent.parentElement;
+    }
+    return {href: link.href, text: (link.innerText || link.textContent).replace(/\\s+/g, ' ').trim(), depth: depth};
+});
+"""
+
+# Pdfs are read from chrome in chunks of this many bytes
+PDF_CHUNK_SIZE = 1024 * 1024
+# Paper sizes in inches
+PAPER_SIZES = {
+    "letter": (8.5, 11),
+    "legal": (8.5, 14),
+    "a3": (11.69, 16.54),
+    "a4": (8.27, 11.69),
+    "a5": (5.83, 8.27),
+}
+
+# Progress of a conversion, written to the output directory after every page
+CHECKPOINT = "{}/checkpoint.json"
+
+# Gemini quota shared by every request of the process
+GEMINI_RPM = 60
+GEMINI_TPM = 1_000_000
+# Transient errors are retried at most GEMINI_MAX_RETRIES times per request, backing off exponentially from
+# GEMINI_BACKOFF seconds; retries across the run are bounded by GEMINI_RETRY_BUDGET
+GEMINI_MAX_RETRIES = 5
+GEMINI_RETRY_BUDGET = 20
+GEMINI_BACKOFF = 2
+GEMINI_MAX_BACKOFF = 120
+# Invalid JSON answers are asked for again this many times
+GEMINI_JSON_RETRIES = 2
+# Tokens gemini counts for an image
+GEMINI_IMAGE_TOKENS = 258
+# Gemini responses are kept here, keyed by the model, its system prompt and the prompt, so reruns of a book don't pay
+# for the same answers again; the least recently used responses beyond GEMINI_CACHE_ENTRIES are evicted. None
+# disables the cache
+GEMINI_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "htmlbooktopdf", "gemini"
+)
+GEMINI_CACHE_ENTRIES = 10_000
+# Retry delays suggested in gemini error messages
+RETRY_AFTER_PATTERNS = (
+    r"retry_delay\s*\{\s*seconds:\s*(\d+)",
+    r"retry (?:in|after) (\d+(?:\.\d+)?)\s*s",
+)
+
+# Navigation prompts only carry the features of this many previous pages and the urls of this many recent pages
+PROMPT_FEATURE_WINDOW = 5
+PROMPT_RECENT_PAGES = 3
+
+# Pins the chromedriver installed by webdriver_manager so later runs don't hit the network
+DRIVER_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "htmlbooktopdf", "chromedriver.json"
+)
+# Browser kept alive across conversions by get_driver
+warm_driver = None
+
+# Chrome's http cache is kept here between runs, in one directory per browser open at once (browsers can't share a
+# cache directory); chrome honours cache headers and evicts the least recently used entries beyond HTTP_CACHE_SIZE
+# bytes per directory. None disables the persistent cache
+HTTP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "htmlbooktopdf", "http")
+HTTP_CACHE_SIZE = 512 * 1024 * 1024
+# Cache directories claimed by browsers of this process
+http_caches = set()
+http_cache_lock = threading.Lock()
+
+# Hashes the whitespace-normalized text of the page's main content with a 53 bit rolling hash (cyrb53), so only
+# the fingerprint crosses the wire; pages with less text than arguments[0] (image only pages, content filled in by
+# scripts, a small <article> repeated on every page) get null, as their text says nothing about which page they are
+PAGE_FINGERPRINT_SCRIPT = """
+var main = document.querySelector('main, article, [role="main"]') || document.body;
+var text = (main.innerText || main.textContent || '').replace(/\\s+/g, ' ').trim();
+if (text.length < arguments[0]) {
+    return null;
+}
+var h1 = 0xdeadbeef, h2 = 0x41c6ce57;
+for (var i = 0; i < text.length; i++) {
+    var ch = text.charCodeAt(i);
+    h1 = Math.imul(h1 ^ ch, 2654435761);
+    h2 = Math.imul(h2 ^ ch, 1597334677);
+}
+h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+return text.length + ':' + (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(16);
+"""
+# Pages with less main text than this aren't fingerprinted, so they are never taken for duplicates
+FINGERPRINT_MIN_TEXT = 200
+# Navigation stops after this many consecutive clicks that led back to pages we already have
+LOOP_LIMIT = 3
+
+# Timed events of a conversion (one JSON object per line), its summary and optional profile
+EVENTS = "{}/events.jsonl"
+RUN_REPORT = "{}/run_report.json"
+PROFILE = "{}/profile.prof"
+# Event fields that are totalled in the run summary
+REPORT_TOTALS = (
+    "prompt_tokens",
+    "response_tokens",
+    "prompt_bytes",
+    "saved_tokens",
+    "screenshot_bytes",
+    "pdf_bytes",
+    "part_bytes",
+    "requests",
+    "cache_hits",
+    "network_bytes",
+    "blocked_requests",
+    "removed_elements",
+    "cached_responses",
+    "output_bytes",
+    "retries",
+)
+
+# Number of browsers printing pages in parallel; with more than one, the page order is discovered first and the
+# pages are printed afterwards
+WORKERS = 1
+
+# Pages stitched into each document printed by compose_pages, and the ceiling in seconds on fetching them and
+# loading their images
+COMPOSE_BATCH_PAGES = 100
+COMPOSE_TIMEOUT = 120
+# Fetches the pages at arguments[0] (numbered from arguments[1]) and replaces the body of the current document with
+# the main content of each, in order, each page starting on a new sheet. Pages are decoded with their declared
+# charset, relative urls (including those in styles) are resolved against the page they came from, ids are prefixed
+# with the id of their page's section, links between the composed pages become links within the document and the
+# pages' stylesheets are added to the head. Resolves once images and fonts have loaded, or when the ceiling
+# (arguments[2] milliseconds) is reached, with the number of pages composed or the error that stopped it
+COMPOSE_SCRIPT = """
+var urls = arguments[0];
+var first = arguments[1];
+var done = arguments[arguments.length - 1];
+var deadline = Date.now() + arguments[2];
+var anchors = {};
+urls.forEach(function (url, index) {
+    anchors[url.split('#')[0]] = 'htmlbooktopdf-page-' + (first + index);
+});
+var stylesheets = new Set(Array.from(document.querySelectorAll('link[rel~="stylesheet"]'), function (link) {
+    return link.href;
+}));
+var styles = new Set(Array.from(document.querySelectorAll('style'), function (style) {
+    return style.textContent;
+}));
+function absolute(value, base) {
+    try {
+        return new URL(value, base).href;
+    } catch (e) {
+        return value;
+    }
+}
+// Decodes a page with the charset of its Content-Type header, else of its <meta> tags, else as UTF-8
+function decode(buffer, contentType) {
+    var pattern = /charset\\s*=\\s*["']?([\\w.:-]+)/i;
+    var match = pattern.exec(contentType || '');
+    if (!match) {
+        // <meta> must come within the first 1024 bytes, which are ASCII in every charset a page can declare
+        match = pattern.exec(new TextDecoder('latin1').decode(buffer.slice(0, 1024)));
+    }
+    try {
+        return new TextDecoder(match ? match[1] : 'utf-8').decode(buffer);
+    } catch (e) {
+        // Unknown charset labels make TextDecoder throw
+        return new TextDecoder('utf-8').decode(buffer);
+    }
+}
+// Resolves the url(...) and @import references of a stylesheet against the page it came from
+function resolveCss(css, base) {
+    return css.replace(/url\\(\\s*(['"]?)([^'")]+)\\1\\s*\\)/g, function (match, quote, value) {
+        if (/^(data:|#)/.test(value)) {
+            return match;
+        }
+        return 'url(' + quote + absolute(value, base) + quote + ')';
+    }).replace(/@import\\s+(['"])([^'"]+)\\1/g, function (match, quote, value) {
+        return '@import ' + quote + absolute(value, base) + quote;
+    });
+}
+function compose(html, url, index) {
+    var page = new DOMParser().parseFromString(html, 'text/html');
+    // Ids are prefixed with the id of the page's section, so the same id on two pages can't collide
+    var prefix = anchors[url.split('#')[0]] + '-';
+    page.querySelectorAll('link[rel~="stylesheet"][href]').forEach(function (link) {
+        var href = absolute(link.getAttribute('href'), url);
+        if (!stylesheets.has(href)) {
+            stylesheets.add(href);
+            var stylesheet = document.createElement('link');
+            stylesheet.rel = 'stylesheet';
+            stylesheet.href = href;
+            document.head.appendChild(stylesheet);
+        }
+    });
+    page.querySelectorAll('style').forEach(function (style) {
+        var css = resolveCss(style.textContent, url);
+        if (!styles.has(css)) {
+            styles.add(css);
+            var copy = document.createElement('style');
+            copy.textContent = css;
+            document.head.appendChild(copy);
+        }
+    });
+    var content = page.querySelector('main, article, [role="main"]') || page.body;
+    content.querySelectorAll('script, noscript, header, footer').forEach(function (element) {
+        element.remove();
+    });
+    content.querySelectorAll('[src]').forEach(function (element) {
+        element.setAttribute('src', absolute(element.getAttribute('src'), url));
+    });
+    content.querySelectorAll('[srcset]').forEach(function (element) {
+        element.setAttribute('srcset', element.getAttribute('srcset').split(',').map(function (candidate) {
+            var parts = candidate.trim().split(/\\s+/);
+            parts[0] = absolute(parts[0], url);
+            return parts.join(' ');
+        }).join(', '));
+    });
+    content.querySelectorAll('[style]').forEach(function (element) {
+        element.setAttribute('style', resolveCss(element.getAttribute('style'), url));
+    });
+    content.querySelectorAll('[id]').forEach(function (element) {
+        element.id = prefix + element.id;
+    });
+    content.querySelectorAll('a[name]').forEach(function (element) {
+        element.setAttribute('name', prefix + element.getAttribute('name'));
+    });
+    content.querySelectorAll('label[for]').forEach(function (element) {
+        element.setAttribute('for', prefix + element.getAttribute('for'));
+    });
+    // Images below the fold would otherwise never load before printing
+    content.querySelectorAll('img[loading]').forEach(function (image) {
+        image.setAttribute('loading', 'eager');
+    });
+    content.querySelectorAll('a[href]').forEach(function (link) {
+        var href = link.getAttribute('href');
+        if (href.charAt(0) === '#') {
+            link.setAttribute('href', href.length > 1 ? '#' + prefix + href.slice(1) : '#' + prefix.slice(0, -1));
+            return;
+        }
+        var target = absolute(href, url).split('#');
+        if (anchors[target[0]] !== undefined) {
+            // Links to composed pages point at their section, or at the prefixed id within it
+            link.setAttribute('href', '#' + anchors[target[0]] + (target[1] ? '-' + target[1] : ''));
+        } else {
+            link.setAttribute('href', target.join('#'));
+        }
+    });
+    var section = document.createElement('section');
+    section.id = anchors[url.split('#')[0]];
+    if (index > 0) {
+        section.style.breakBefore = 'page';
+    }
+    Array.from(content.childNodes).forEach(function (node) {
+        section.appendChild(document.importNode(node, true));
+    });
+    return section;
+}
+function loaded() {
+    var images = Array.from(document.images).filter(function (image) {
+        return !image.complete;
+    }).map(function (image) {
+        return new Promise(function (resolve) {
+            image.addEventListener('load', resolve);
+            image.addEventListener('error', resolve);
+        });
+    });
+    return Promise.all(images).then(function () {
+        return document.fonts ? document.fonts.ready : null;
+    });
+}
+Promise.all(urls.map(function (url) {
+    return fetch(url).then(function (response) {
+        if (!response.ok) {
+            throw new Error(response.status + ' fetching ' + url);
+        }
+        var contentType = response.headers.get('Content-Type');
+        return response.arrayBuffer().then(function (buffer) {
+            return decode(buffer, contentType);
+        });
+    });
+})).then(function (pages) {
+    var sections = pages.map(function (html, index) {
+        return compose(html, urls[index], index);
+    });
+    document.body.replaceChildren.apply(document.body, sections);
+    return Promise.race([
+        loaded(),
+        new Promise(function (resolve) {
+            setTimeout(resolve, Math.max(deadline - Date.now(), 0));
+        })
+    ]);
+}).then(function () {
+    done({composed: urls.length, bytes: document.documentElement.outerHTML.length});
+}, function (error) {
+    done({error: String(error)});
+});
 """
 
+# Books convert_batch converts at once, and the browsers they may have open between them
+BATCH_BOOKS = 2
+BATCH_BROWSERS = 4
+# Memory that must be available for every browser of a book before a batch starts it, and how often to check again
+BROWSER_MEMORY = 512 * 1024 * 1024
+BATCH_MEMORY_POLL = 5
+# Attempts per book of a batch; later attempts resume from the checkpoint of the failed one
+BATCH_ATTEMPTS = 3
+BATCH_RETRY_DELAY = 30
+
 table_of_contents_ai = genai.GenerativeModel(
     "gemini-1.5-pro-latest", system_instruction=TABLE_OF_CONTENTS_SYSTEM_PROMPT
 )
 gemini = genai.GenerativeModel(
     "gemini-1.5-pro-latest", system_instruction=SYSTEM_PROMPT
 )
+toc_links_ai = genai.GenerativeModel(
+    "gemini-1.5-pro-latest", system_instruction=TOC_LINKS_SYSTEM_PROMPT
+)
 
-if len(sys.argv) != 4:
-    print(
-        "Usage: python convert.py <url of table of contents/home page of html book> <output_dir> <title of book>"
+
+class ConversionError(Exception):
+    """
+    Raised when a book can't be converted as asked, e.g. when its table of contents is rejected; retrying won't help
+    """
+
+
+class CacheMissError(ConversionError):
+    """
+    Raised when a replay only ResponseCache doesn't have the response to a prompt
+    """
+
+
+class ResponseCache:
+    """
+    Persistent cache of gemini responses, one JSON file per response named after a hash of the model name, its
+    system prompt and the prompt's text and images
+
+    Hits refresh the modification time of a response, and the least recently used responses are evicted beyond
+    max_entries; with replay_only, a miss raises CacheMissError instead of letting gemini be called
+    """
+
+    def __init__(
+        self,
+        path=GEMINI_CACHE_DIR,
+        max_entries=GEMINI_CACHE_ENTRIES,
+        replay_only=False,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.replay_only = replay_only
+        # Counted on the first store
+        self.entries = None
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, model, contents):
+        system_prompt = str(getattr(model, "_system_instruction", ""))
+        digest = hashlib.sha256()
+        digest.update(model.model_name.encode() + b"\0")
+        digest.update(hashlib.sha256(system_prompt.encode()).digest())
+        for part in contents:
+            if isinstance(part, str):
+                data = b"text:" + part.encode()
+            else:
+                image = part["data"]
+                data = f"{part['mime_type']}:".encode() + (
+                    image if isinstance(image, bytes) else str(image).encode()
+                )
+            # Lengths keep the boundaries between parts unambiguous
+            digest.update(f"{len(data)}:".encode() + data)
+        return digest.hexdigest()
+
+    def get(self, model, contents):
+        """
+        Returns the cached response to contents, or None (raising CacheMissError when replaying only)
+        """
+        path = os.path.join(self.path, self.key(model, contents) + ".json")
+        try:
+            with open(path) as file:
+                cached = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            if self.replay_only:
+                raise CacheMissError(
+                    f"No cached {model.model_name} response to replay for this prompt"
+                )
+            return None
+        return SimpleNamespace(text=cached["text"], usage_metadata=None)
+
+    def put(self, model, contents, response):
+        try:
+            text = response.text
+        except ValueError:
+            # Blocked or empty responses have no text to cache
+            return
+        path = os.path.join(self.path, self.key(model, contents) + ".json")
+        with open(path + ".tmp", "w") as file:
+            json.dump({"model": model.model_name, "text": text}, file)
+        new = not os.path.exists(path)
+        os.replace(path + ".tmp", path)
+        if new:
+            self.evict()
+
+    def discard(self, model, contents):
+        """
+        Forgets the response to contents, e.g. when it turned out to be wrong
+        """
+        path = os.path.join(self.path, self.key(model, contents) + ".json")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def evict(self):
+        with self.lock:
+            if self.entries is None:
+                self.entries = sum(name.endswith(".json") for name in os.listdir(self.path))
+            else:
+                self.entries += 1
+            if self.entries <= self.max_entries:
+                return
+            responses = [
+                entry
+                for entry in os.scandir(self.path)
+                if entry.name.endswith(".json")
+            ]
+            responses.sort(key=lambda entry: entry.stat().st_mtime)
+            # Evict a tenth more than needed so the directory isn't listed on every store
+            keep = self.max_entries * 9 // 10
+            for entry in responses[: max(len(responses) - keep, 0)]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            self.entries = min(len(responses), keep)
+
+
+class RequestScheduler:
+    """
+    Rate limits and retries gemini requests so a run stays close to, but under, its requests and tokens per minute
+
+    Requests wait on token buckets refilled at rpm and tpm; transient errors are retried with exponential backoff and
+    jitter (or the delay suggested by the error) while the shared retry budget lasts, and unparseable JSON answers
+    are re-requested without backing off. Responses already in cache (a ResponseCache) are returned without a request
+    """
+
+    def __init__(
+        self,
+        rpm=GEMINI_RPM,
+        tpm=GEMINI_TPM,
+        max_retries=GEMINI_MAX_RETRIES,
+        retry_budget=GEMINI_RETRY_BUDGET,
+        json_retries=GEMINI_JSON_RETRIES,
+        cache=None,
+    ):
+        self.cache = cache
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.max_retry_budget = retry_budget
+        self.retry_budget = float(retry_budget)
+        self.json_retries = json_retries
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        """
+        Blocks until a request of about `tokens` prompt tokens fits in the rate limits
+        """
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+                self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+                if now >= self.paused_until and self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    self.paused_until - now,
+                    (1 - self.requests) * 60 / self.rpm,
+                    (tokens - self.tokens) * 60 / self.tpm,
+                )
+            time.sleep(max(wait, 0.01))
+
+    def generate(self, model, contents, report=None, store=True):
+        """
+        Calls model.generate_content(contents) within the rate limits, retrying transient errors, unless the response
+        is cached; with store=False, the caller caches the response once it has been accepted
+
+        The call, including its waits and retries, is recorded as a "gemini" event of report
+        """
+        with stage(report, "gemini", model=model.model_name) as event:
+            if self.cache is not None:
+                response = self.cache.get(model, contents)
+                if response is not None:
+                    event["cached_responses"] = 1
+                    return response
+            response = self._generate(model, contents, event)
+            usage = getattr(response, "usage_metadata", None)
+            if usage is not None:
+                event["prompt_tokens"] = getattr(usage, "prompt_token_count", 0)
+                event["response_tokens"] = getattr(usage, "candidates_token_count", 0)
+            if store and self.cache is not None:
+                self.cache.put(model, contents, response)
+            return response
+
+    def _generate(self, model, contents, event):
+        estimate = estimate_prompt_tokens(contents)
+        attempt = 0
+        while True:
+            self.acquire(estimate)
+            try:
+                response = model.generate_content(contents)
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                attempt += 1
+                event["retries"] = attempt
+                with self.lock:
+                    if attempt > self.max_retries or self.retry_budget < 1:
+                        raise
+                    self.retry_budget -= 1
+                hint = retry_after(e)
+                delay = random.uniform(
+                    0, min(GEMINI_MAX_BACKOFF, GEMINI_BACKOFF * 2**attempt)
+                )
+                if hint is not None:
+                    # The quota is shared, so every request waits for the suggested delay
+                    delay = max(delay, hint)
+                    with self.lock:
+                        self.paused_until = max(
+                            self.paused_until, time.monotonic() + hint
+                        )
+                print(f"Gemini request failed ({e}); retrying in {delay:.1f} seconds")
+                time.sleep(delay)
+                continue
+            with self.lock:
+                self.retry_budget = min(self.max_retry_budget, self.retry_budget + 0.1)
+                # Charge the tokens that were actually used rather than the estimate
+                usage = getattr(response, "usage_metadata", None)
+                if usage is not None and getattr(usage, "prompt_token_count", 0):
+                    self.tokens -= usage.prompt_token_count - estimate
+            return response
+
+    def generate_json(self, model, contents, report=None):
+        """
+        Like generate, but parses the response as JSON and asks again when the model doesn't return valid JSON
+
+        Only a valid answer is cached, under the original contents, so a rerun or replay gets it without asking again
+        """
+        prompt = contents
+        for attempt in range(self.json_retries + 1):
+            response = self.generate(model, prompt, report, store=False)
+            try:
+                parsed = parse_json_response(response.text)
+            except ValueError as e:
+                if self.cache is not None:
+                    # An invalid answer may have been cached by an older run
+                    self.cache.discard(model, prompt)
+                if attempt == self.json_retries:
+                    raise
+                print(f"Gemini returned invalid JSON ({e}); asking again")
+                prompt = list(contents) + [
+                    "Your previous answer was not valid JSON. Return ONLY the JSON object."
+                ]
+                continue
+            if self.cache is not None:
+                self.cache.put(model, contents, response)
+            return parsed
+
+
+scheduler = RequestScheduler(
+    cache=ResponseCache() if GEMINI_CACHE_DIR is not None else None
+)
+
+
+class RunReport:
+    """
+    Records timed events for the stages of a conversion, appends them to a JSON lines log and summarizes them
+
+    Every event has a "stage", a timestamp and, for timed stages, its wall time in "seconds", along with stage
+    specific fields such as tokens, bytes or the xpath fallback level; callables in sinks receive every event as it
+    is recorded, so other instrumentation can be plugged in
+    """
+
+    def __init__(self, path=None, sinks=(), append=False):
+        self.path = path
+        self.sinks = list(sinks)
+        self.events = []
+        self.lock = threading.Lock()
+        self.file = open(path, "a" if append else "w") if path is not None else None
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """
+        Times the enclosed block and records it as a `name` event; the block can add fields to the yielded event
+        """
+        event = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException as e:
+            event["error"] = repr(e)
+            raise
+        finally:
+            event["seconds"] = time.perf_counter() - start
+            self.record(name, **event)
+
+    def record(self, stage, **fields):
+        event = {"time": time.time(), "stage": stage, **fields}
+        with self.lock:
+            self.events.append(event)
+            if self.file is not None:
+                self.file.write(json.dumps(event, default=str) + "\n")
+                self.file.flush()
+        for sink in self.sinks:
+            sink(event)
+        return event
+
+    def summary(self):
+        """
+        Returns per stage event counts, wall time percentiles, error counts, totals of REPORT_TOTALS fields and
+        counts of each "level"
+        """
+        with self.lock:
+            events = list(self.events)
+        stages = {}
+        for event in events:
+            stages.setdefault(event["stage"], []).append(event)
+        summary = {}
+        for name, stage_events in stages.items():
+            entry = {"count": len(stage_events)}
+            seconds = [event["seconds"] for event in stage_events if "seconds" in event]
+            if seconds:
+                entry.update(
+                    total=round(sum(seconds), 3),
+                    p50=round(percentile(seconds, 0.5), 4),
+                    p90=round(percentile(seconds, 0.9), 4),
+                    p99=round(percentile(seconds, 0.99), 4),
+                    max=round(max(seconds), 4),
+                )
+            errors = sum("error" in event for event in stage_events)
+            if errors:
+                entry["errors"] = errors
+            for field in REPORT_TOTALS:
+                values = [event[field] for event in stage_events if field in event]
+                if values:
+                    entry[field] = sum(values)
+            levels = [event["level"] for event in stage_events if "level" in event]
+            if levels:
+                entry["levels"] = {level: levels.count(level) for level in set(levels)}
+            summary[name] = entry
+        return summary
+
+    def close(self, summary_path=None):
+        """
+        Writes the summary to summary_path (if given), closes the event log and returns the summary
+        """
+        summary = self.summary()
+        if summary_path is not None:
+            with open(summary_path, "w") as file:
+                json.dump(summary, file, indent=2)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return summary
+
+
+class BrowserGate:
+    """
+    Limits the browsers open across the books of a batch, and only starts a book while there is memory for its
+    browsers (unless nothing else is running, so a book always gets to run)
+    """
+
+    def __init__(self, browsers=BATCH_BROWSERS, memory_per_browser=BROWSER_MEMORY):
+        self.browsers = browsers
+        self.memory_per_browser = memory_per_browser
+        self.open = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, browsers):
+        """
+        Blocks until `browsers` more browsers may be opened and holds them for the enclosed block
+        """
+        browsers = min(browsers, self.browsers)
+        with self.condition:
+            while True:
+                if self.open + browsers <= self.browsers:
+                    memory = available_memory()
+                    if (
+                        self.open == 0
+                        or memory is None
+                        or memory >= browsers * self.memory_per_browser
+                    ):
+                        break
+                    # Memory is also freed outside the batch, so check again every so often
+                    self.condition.wait(BATCH_MEMORY_POLL)
+                else:
+                    self.condition.wait()
+            self.open += browsers
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.open -= browsers
+                self.condition.notify_all()
+
+
+def available_memory():
+    """
+    Returns the bytes of memory available for new processes, or None where /proc/meminfo doesn't exist
+    """
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Prefetcher:
+    """
+    Speculatively loads the likely next page in a second tab of the browser while the current page is printed and
+    gemini decides, and swaps to that tab when navigation confirms the guess, so the page load overlaps other work
+    """
+
+    def __init__(self, driver, report=None):
+        self.driver = driver
+        self.report = report
+        self.url = None
+        self.handle = None
+
+    def start(self, url):
+        """
+        Starts loading url in the background tab, replacing a different page loaded there before
+        """
+        if self.handle is not None and normalize_url(url) == normalize_url(self.url):
+            return
+        self.cancel()
+        with stage(self.report, "prefetch", url=url):
+            current = self.driver.current_window_handle
+            self.driver.switch_to.new_window("tab")
+            self.handle = self.driver.current_window_handle
+            self.url = url
+            # Every tab needs its own lifecycle events and request blocking
+            enable_lifecycle_events(self.driver)
+            block_requests(self.driver)
+            # Unlike driver.get, Page.navigate returns without waiting for the page to load
+            send_command(self.driver, "Page.navigate", {"url": url})
+            self.driver.switch_to.window(current)
+
+    def take(self, url):
+        """
+        Switches to the background tab if it is loading url, closing the current tab, and returns whether it did
+        """
+        if self.handle is None or normalize_url(url) != normalize_url(self.url):
+            self.cancel()
+            return False
+        self.driver.close()
+        self.driver.switch_to.window(self.handle)
+        self.handle = None
+        self.url = None
+        return True
+
+    def cancel(self):
+        """
+        Closes the background tab, if any
+        """
+        if self.handle is None:
+            return
+        current = self.driver.current_window_handle
+        self.driver.switch_to.window(self.handle)
+        self.driver.close()
+        self.driver.switch_to.window(current)
+        self.handle = None
+        self.url = None
+
+
+@contextlib.contextmanager
+def stage(report, name, **fields):
+    """
+    Times the enclosed block as a `name` event of report, or just yields a scratch event without a report
+    """
+    if report is None:
+        yield dict(fields)
+        return
+    with report.stage(name, **fields) as event:
+        yield event
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of values
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def print_summary(summary):
+    for name, entry in summary.items():
+        line = f"{name}: {entry['count']} events"
+        if "total" in entry:
+            line += f", {entry['total']:.1f}s total, p50 {entry['p50']:.3f}s, p90 {entry['p90']:.3f}s, p99 {entry['p99']:.3f}s"
+        for field in REPORT_TOTALS + ("errors", "levels"):
+            if field in entry:
+                line += f", {field} {entry[field]}"
+        print(line)
+    requests = sum(entry.get("requests", 0) for entry in summary.values())
+    if requests:
+        cache_hits = sum(entry.get("cache_hits", 0) for entry in summary.values())
+        print(f"HTTP cache: {cache_hits} of {requests} requests ({cache_hits / requests:.0%})")
+    blocked = sum(entry.get("blocked_requests", 0) for entry in summary.values())
+    removed = sum(entry.get("removed_elements", 0) for entry in summary.values())
+    if blocked or removed:
+        print(f"Blocked {blocked} requests and removed {removed} elements")
+
+
+def estimate_prompt_tokens(contents):
+    """
+    Estimates the prompt tokens of generate_content contents; images count as a fixed number of tokens
+    """
+    return sum(
+        estimate_tokens(len(part)) if isinstance(part, str) else GEMINI_IMAGE_TOKENS
+        for part in contents
     )
 
-# Note that the URL should be the main page containing the table of contents
-URL = sys.argv[1]
-OUTPUT_DIR = sys.argv[2]
-TITLE = sys.argv[3]
+
+def parse_json_response(text):
+    """
+    Parses a JSON answer from gemini, which often wraps it in a markdown code block
+    """
+    return json.loads(text.replace("```json\n", "").replace("```", "").strip())
 
 
-def quit(driver, home, merger):
-    print("Quitting")
-    driver.quit()
-    home.close()
-    merger.close()
-    exit()
+def retryable(error):
+    """
+    Returns whether a gemini error is transient (quota, overload, timeouts, connection problems)
+    """
+    return isinstance(
+        error,
+        (
+            api_exceptions.ResourceExhausted,
+            api_exceptions.TooManyRequests,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.InternalServerError,
+            api_exceptions.DeadlineExceeded,
+            ConnectionError,
+            TimeoutError,
+        ),
+    )
+
+
+def retry_after(error):
+    """
+    Returns the retry delay in seconds suggested by a gemini error, if any
+    """
+    for pattern in RETRY_AFTER_PATTERNS:
+        match = re.search(pattern, str(error), re.IGNORECASE)
+        if match:
+            return float(match.group(1))
+    return None
+
 
 
 def set_content(
@@ -257,96 +1397,348 @@ def set_content(
     height=None,
     max_width=10000,
     max_height=10000,
-    timeout=2,
+    timeout=None,
     filter=True,
+    report=None,
 ):
-    try:
-        WebDriverWait(driver, timeout).until(
-            EC.presence_of_all_elements_located(
-                (By.XPATH, "//*[contains(@style, 'overflow-y')]")
-            )
+    with stage(report, "set_content") as event:
+        # Wait for the page to settle instead of sleeping for a fixed time
+        network = {
+            "requests": 0,
+            "cache_hits": 0,
+            "network_bytes": 0,
+            "blocked_requests": 0,
+        }
+        event["ready_seconds"] = wait_until_ready(driver, timeout, network)
+        event.update(network)
+        # Filter, unravel scrollable elements and measure the page in a single round trip
+        page = driver.execute_script(
+            PREPARE_PAGE_SCRIPT,
+            FILTER_STYLE if filter else None,
+            ", ".join(REMOVED_SELECTORS) if filter else None,
         )
-    except TimeoutException:
-        pass
-    # Filter content if set
-    if filter:
-        filter_content(driver)
-    # Set the body to scroll
-    driver.execute_script(
-        "window.document.body.style.overflowY = 'scroll';",
-    )
-    # Remove any properties that might constrain the height of the body
-    driver.execute_script("window.document.body.style.height = 'auto';")
-    driver.execute_script("document.body.style.overflow = 'auto';")
-    # Find and unravel any scrollable elements
-    vertically_scrollable_elements = driver.find_elements(
-        By.XPATH, "//*[contains(@style, 'overflow-y')]"
-    )
-    for element in vertically_scrollable_elements:
-        # Skip the body element
-        if element.tag_name == "body":
-            continue
-        driver.execute_script("arguments[0].style.overflow-y = 'visible';", element)
-    scrollable_elements = driver.find_elements(
-        By.XPATH, "//*[contains(@style, 'overflow')]"
+        event["removed_elements"] = page["removed"]
+        # Show all content by setting window height to the height of the body
+        if width is None:
+            width = page["width"]
+        if height is None:
+            height = page["height"]
+        driver.set_window_size(min(max_width, width), min(max_height, height))
+        # Count the round trips a call per style change, element lookup and measurement would have taken
+        round_trips = (
+            int(filter)
+            + 5
+            + page["vertically_scrollable"] * 2
+            - page["body_vertically_scrollable"]
+            + page["scrollable"] * 2
+            - page["body_scrollable"]
+            + 2
+        )
+        event["round_trips_saved"] = round_trips - 1
+    print(
+        f"Prepared page with 1 round trip instead of {round_trips} "
+        f"({page['unscrolled']} scrollable elements unravelled)"
     )
-    for element in scrollable_elements:
-        # Skip the body element
-        if element.tag_name == "body":
-            continue
-        driver.execute_script("arguments[0].style.overflow = 'visible';", element)
-    # Show all content by setting window height to the height of the body
-    if width is None:
-        width = driver.execute_script("return window.document.body.scrollWidth")
-    if height is None:
-        height = driver.execute_script("return window.document.body.scrollHeight")
-    driver.set_window_size(min(max_width, width), min(max_height, height))
 
 
-def save_screenshot(driver, output_path):
-    # Method for saving a screenshot of the full website
-    try:
-        driver.find_element(By.TAG_NAME, "body").screenshot(output_path)
-        return True
-    except Exception as e:
-        print(e)
-        return False
+def capture_screenshot(
+    driver,
+    max_width=SCREENSHOT_MAX_WIDTH,
+    max_height=SCREENSHOT_MAX_HEIGHT,
+    max_bytes=SCREENSHOT_MAX_BYTES,
+    image_format=SCREENSHOT_FORMAT,
+    debug_path=None,
+    report=None,
+):
+    """
+    Captures the top tile of the current page in memory, downscaled and re-encoded to fit in max_bytes
+
+    Returns an inline image that can be passed straight to gemini; the image is only written to debug_path if given
+    """
+    with stage(report, "screenshot") as event:
+        screenshot = _capture_screenshot(
+            driver, max_width, max_height, max_bytes, image_format, debug_path
+        )
+        event["screenshot_bytes"] = len(screenshot["data"])
+    return screenshot
+
+
+def _capture_screenshot(
+    driver, max_width, max_height, max_bytes, image_format, debug_path
+):
+    width, height = driver.execute_script(
+        "return [document.documentElement.scrollWidth, document.documentElement.scrollHeight];"
+    )
+    width = max(1, min(width, SCREENSHOT_TILE_WIDTH))
+    height = max(1, min(height, SCREENSHOT_TILE_HEIGHT))
+    scale = min(1, max_width / width, max_height / height)
+    # Let chrome crop and downscale the tile so the full-size page never leaves the browser
+    result = send_command(
+        driver,
+        "Page.captureScreenshot",
+        {
+            "format": image_format.lower(),
+            "quality": SCREENSHOT_QUALITY,
+            "captureBeyondViewport": True,
+            "clip": {"x": 0, "y": 0, "width": width, "height": height, "scale": scale},
+        },
+    )
+    data = base64.b64decode(result["data"])
+    if len(data) > max_bytes:
+        data = shrink_image(data, max_bytes, image_format)
+    if debug_path is not None:
+        with open(debug_path, "wb") as file:
+            file.write(data)
+    return {"mime_type": f"image/{image_format.lower()}", "data": data}
+
+
+def shrink_image(data, max_bytes, image_format=SCREENSHOT_FORMAT):
+    """
+    Re-encodes an image at decreasing quality, then decreasing size, until it fits in max_bytes
+    """
+    with PIL.Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+        quality = SCREENSHOT_QUALITY
+        while True:
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format.upper(), quality=quality)
+            if buffer.tell() <= max_bytes or image.width < 64 or image.height < 64:
+                return buffer.getvalue()
+            if quality > 40:
+                quality -= 15
+            else:
+                image = image.resize((image.width // 2, image.height // 2))
+
+
+def send_command(driver, cmd, params=None):
+    """
+    Sends a chrome devtools protocol command through the webdriver and returns its result
+    """
+    resource = "/session/%s/chromium/send_command_and_get_result" % driver.session_id
+    url = driver.command_executor._url + resource
+    body = json.dumps({"cmd": cmd, "params": params or {}})
+    response = driver.command_executor._request("POST", url, body)
+
+    if not response or "error" in (response.get("value") or {}):
+        raise Exception(f"{cmd} failed: {response}")
+    return response.get("value")
 
 
 # Code adapted from https://github.com/kumaF/pyhtml2pdf/blob/master/pyhtml2pdf/converter.py
-def save_pdf(driver, output_path, timeout=2):
+def save_pdf(driver, output_path, print_options=None, report=None):
     # Method for converting the current page to a pdf
-    try:
-        WebDriverWait(driver, timeout).until(
-            staleness_of(driver.find_element(by=By.TAG_NAME, value="html"))
-        )
-    except TimeoutException:
-        calculated_print_options = {
-            "landscape": False,
-            "displayHeaderFooter": False,
-            "printBackground": True,
-            "preferCSSPageSize": True,
-        }
-        # calculated_print_options.update(print_options)
-        resource = (
-            "/session/%s/chromium/send_command_and_get_result" % driver.session_id
-        )
-        url = driver.command_executor._url + resource
-        body = json.dumps(
-            {"cmd": "Page.printToPDF", "params": calculated_print_options}
+    # The page is expected to be ready (see set_content), so printing starts right away
+    # The pdf is streamed from chrome in chunks, so it is never held in memory as a whole
+    calculated_print_options = {
+        "landscape": False,
+        "displayHeaderFooter": False,
+        "printBackground": True,
+        "preferCSSPageSize": True,
+        "transferMode": "ReturnAsStream",
+    }
+    if print_options is not None:
+        calculated_print_options.update(print_options)
+    with stage(report, "save_pdf") as event:
+        response = send_command(driver, "Page.printToPDF", calculated_print_options)
+        write_stream(driver, response["stream"], output_path)
+        event["pdf_bytes"] = os.path.getsize(output_path)
+    return
+
+
+def wait_until_ready(driver, timeout=None, network=None):
+    """
+    Waits until the current page is ready to be captured, or for at most timeout (READY_TIMEOUT) seconds
+
+    The page is ready once chrome reports the main frame as network idle or almost idle (lifecycle events read from
+    the performance log; almost idle allows for connections kept open by long polling or streaming) and the page's
+    fonts, MathJax typesetting and highlight.js highlighting have finished. When no new document starts loading
+    within READY_LOAD_GRACE seconds, the network is taken as idle once document.readyState is complete
+
+    The responses read from the log along the way are counted into network: "requests", "cache_hits" (served from
+    the http cache), "network_bytes" (transferred over the network) and "blocked_requests" (see block_requests)
+    """
+    if timeout is None:
+        timeout = READY_TIMEOUT
+    start = time.monotonic()
+    deadline = start + timeout
+    frame_id = send_command(driver, "Page.getFrameTree")["frameTree"]["frame"]["id"]
+    network_idle = False
+    loading = False
+    while not network_idle and time.monotonic() < deadline:
+        try:
+            entries = driver.get_log("performance")
+        except Exception:
+            # Performance logging isn't enabled; rely on the in-page checks
+            break
+        for entry in entries:
+            message = json.loads(entry["message"])["message"]
+            if network is not None:
+                count_network_event(message, network)
+            if message["method"] != "Page.lifecycleEvent":
+                continue
+            if message["params"]["frameId"] != frame_id:
+                continue
+            if message["params"]["name"] == "init":
+                # A new document started loading after an earlier idle event
+                loading = True
+                network_idle = False
+            elif message["params"]["name"] in ("networkIdle", "networkAlmostIdle"):
+                network_idle = True
+        if (
+            not network_idle
+            and not loading
+            and time.monotonic() - start >= READY_LOAD_GRACE
+        ):
+            network_idle = driver.execute_script("return document.readyState") == "complete"
+        if not network_idle:
+            time.sleep(READY_POLL_INTERVAL)
+    remaining = max(deadline - time.monotonic(), 0)
+    driver.set_script_timeout(remaining + 1)
+    state = driver.execute_async_script(READY_SCRIPT, int(remaining * 1000))
+    elapsed = time.monotonic() - start
+    if not network_idle or not state["ready"]:
+        print(
+            f"Page not ready after {elapsed:.1f} seconds "
+            f"(network idle: {network_idle}, {state['pending']}); capturing anyway"
         )
-        response = driver.command_executor._request("POST", url, body)
+    return elapsed
 
-        if not response:
-            raise Exception(response.get("value"))
 
+def count_network_event(message, network):
+    """
+    Counts a Network event of the performance log into network (see wait_until_ready)
+    """
+    if message["method"] == "Network.responseReceived":
+        network["requests"] += 1
+        response = message["params"]["response"]
+        if response.get("fromDiskCache") or response.get("fromPrefetchCache"):
+            network["cache_hits"] += 1
+    elif message["method"] == "Network.loadingFailed":
+        if message["params"].get("blockedReason"):
+            network["blocked_requests"] += 1
+    elif message["method"] == "Network.loadingFinished":
+        # Responses from the cache transfer nothing
+        network["network_bytes"] += int(message["params"].get("encodedDataLength", 0))
+
+
+def enable_lifecycle_events(driver):
+    """
+    Makes chrome report page lifecycle events (load, network idle, ...) to the performance log
+    """
+    send_command(driver, "Page.enable")
+    send_command(driver, "Page.setLifecycleEventsEnabled", {"enabled": True})
+
+
+def block_requests(driver, urls=None, resource_types=None):
+    """
+    Blocks requests for urls (BLOCKED_URLS) and resource_types (BLOCKED_RESOURCE_TYPES) in the browser for all of
+    its pages; blocked requests fail right away instead of being downloaded and run
+    """
+    if urls is None:
+        urls = BLOCKED_URLS
+    if resource_types is None:
+        resource_types = BLOCKED_RESOURCE_TYPES
+    patterns = list(urls)
+    for resource_type in resource_types:
+        patterns.extend(RESOURCE_TYPE_URLS[resource_type])
+    if patterns:
+        send_command(driver, "Network.enable")
+        send_command(driver, "Network.setBlockedURLs", {"urls": patterns})
+
+
+def write_stream(driver, handle, output_path, chunk_size=PDF_CHUNK_SIZE):
+    """
+    Copies a devtools IO stream to output_path one chunk at a time and closes the stream
+    """
+    try:
         with open(output_path, "wb") as file:
-            file.write(base64.b64decode(response.get("value")["data"]))
-        return
+            while True:
+                chunk = send_command(
+                    driver, "IO.read", {"handle": handle, "size": chunk_size}
+                )
+                data = chunk.get("data", "")
+                if chunk.get("base64Encoded"):
+                    file.write(base64.b64decode(data))
+                else:
+                    file.write(data.encode("latin-1"))
+                if chunk.get("eof"):
+                    break
+    finally:
+        send_command(driver, "IO.close", {"handle": handle})
+
+
+def make_print_options(paper_size=None, page_ranges=None):
+    """
+    Builds the Page.printToPDF options for a paper size (a name from PAPER_SIZES or "<width>x<height>" in inches)
+    and page ranges (e.g. "1-5, 8"), so oversized pages can be limited to a fixed paper size
+    """
+    print_options = {}
+    if paper_size is not None:
+        if paper_size.lower() in PAPER_SIZES:
+            width, height = PAPER_SIZES[paper_size.lower()]
+        else:
+            width, height = (float(inches) for inches in paper_size.lower().split("x"))
+        print_options.update(
+            {"paperWidth": width, "paperHeight": height, "preferCSSPageSize": False}
+        )
+    if page_ranges is not None:
+        print_options["pageRanges"] = page_ranges
+    return print_options
+
+
+def chromedriver_path(refresh=False):
+    """
+    Returns the path of the chromedriver to use, downloading it only when no usable driver is pinned
+
+    CHROMEDRIVER_PATH takes precedence; otherwise the path installed by webdriver_manager is pinned in DRIVER_CACHE
+    so later runs start offline. With refresh, the pin is ignored and replaced, e.g. after chrome updated past it
+    """
+    path = os.getenv("CHROMEDRIVER_PATH")
+    if path:
+        return path
+    if not refresh and os.path.exists(DRIVER_CACHE):
+        with open(DRIVER_CACHE) as file:
+            path = json.load(file).get("path")
+        if path and os.access(path, os.X_OK):
+            return path
+    path = ChromeDriverManager().install()
+    os.makedirs(os.path.dirname(DRIVER_CACHE), exist_ok=True)
+    with open(DRIVER_CACHE + ".tmp", "w") as file:
+        json.dump({"path": path}, file)
+    os.replace(DRIVER_CACHE + ".tmp", DRIVER_CACHE)
+    return path
+
+
+def get_driver(keep_alive=False):
+    """
+    Returns a browser for a conversion; with keep_alive, the same warm browser is reused across conversions until
+    release_driver is called
+    """
+    global warm_driver
+    if not keep_alive:
+        return initialize_driver()
+    if warm_driver is None:
+        warm_driver = initialize_driver()
+    else:
+        # Leave the previous book behind before starting the next one
+        warm_driver.get("about:blank")
+        print("Reusing warm browser")
+    return warm_driver
+
+
+def release_driver():
+    """
+    Quits the warm browser kept alive by get_driver
+    """
+    global warm_driver
+    if warm_driver is not None:
+        quit_driver(warm_driver)
+        warm_driver = None
 
 
 def initialize_driver():
     # Initialize webdriver
+    start = time.monotonic()
     options = ChromeOptions()
     # options.add_argument("--headless")
     options.add_argument("--hide-scrollbars")
@@ -356,164 +1748,958 @@ def initialize_driver():
     options.add_argument("--no-sandbox")
     options.add_argument("--start-maximized")
     options.add_argument("--start-fullscreen")
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=options)
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    http_cache = claim_http_cache()
+    if http_cache is not None:
+        options.add_argument(f"--disk-cache-dir={http_cache[0]}")
+        options.add_argument(f"--disk-cache-size={HTTP_CACHE_SIZE}")
     # options.service_args = ["--verbose", "--enable-logging --v=1"]
-    # options.set_capability("goog:loggingPrefs", {driver: "ALL"})
-    driver = webdriver.Chrome(options=options)
+    try:
+        try:
+            driver = webdriver.Chrome(
+                service=Service(chromedriver_path()), options=options
+            )
+        except SessionNotCreatedException:
+            if os.getenv("CHROMEDRIVER_PATH"):
+                raise
+            # Chrome updated past the pinned driver; install a matching one once
+            print("Pinned chromedriver doesn't match chrome; installing a new one")
+            driver = webdriver.Chrome(
+                service=Service(chromedriver_path(refresh=True)), options=options
+            )
+    except Exception:
+        release_http_cache(http_cache)
+        raise
+    driver.http_cache = http_cache
     # driver.implicitly_wait(2)
+    # Lifecycle events are read from the performance log by wait_until_ready
+    enable_lifecycle_events(driver)
+    block_requests(driver)
+    print(f"Started browser in {time.monotonic() - start:.2f} seconds")
     return driver
 
 
-def filter_content(driver):
+def quit_driver(driver):
     """
-    Filters content to remove elements that are likely unnecessary for retrieving the book's content
+    Quits a browser started by initialize_driver and gives its http cache directory back
     """
-    driver.execute_script(
-        """
-        var style = document.createElement('style');
-        style.innerHTML = `
-            @page {
-                margin: 0 !important;
-                padding: 0 !important;
-            }
-            header, footer {
-                display: none !important;
-            }
-        `;
-        document.head.appendChild(style);
-        """
-    )
+    try:
+        driver.quit()
+    finally:
+        release_http_cache(getattr(driver, "http_cache", None))
 
 
-def convert(url, output_dir, title):
+def claim_http_cache():
+    """
+    Claims the first cache directory in HTTP_CACHE_DIR no other browser is using, in this process or another, and
+    returns its path and lock file, or None when the persistent cache is disabled
+    """
+    if HTTP_CACHE_DIR is None:
+        return None
+    slot = 0
+    while True:
+        path = os.path.join(HTTP_CACHE_DIR, str(slot))
+        slot += 1
+        with http_cache_lock:
+            if path in http_caches:
+                continue
+            os.makedirs(path, exist_ok=True)
+            lock = open(path + ".lock", "w")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another process is using this directory
+                    lock.close()
+                    continue
+            http_caches.add(path)
+            return path, lock
+
+
+def release_http_cache(http_cache):
+    if http_cache is None:
+        return
+    path, lock = http_cache
+    with http_cache_lock:
+        http_caches.discard(path)
+    # Closing the lock file releases the lock
+    lock.close()
+
+
+def convert(
+    url,
+    output_dir,
+    title,
+    rule_threshold=RULE_THRESHOLD,
+    debug=False,
+    workers=WORKERS,
+    navigation="llm",
+    print_options=None,
+    resume=False,
+    keep_alive=False,
+    confirm=True,
+    report=None,
+    profile=False,
+    compose=False,
+    prefetch=True,
+):
     """
     Converts pages to pdfs one at a time and then joins them using pypdf
+
+    navigation is "llm" to let gemini find the next page on every page, "toc" to take the page order from the linked
+    table of contents on the home page, or "auto" to use the table of contents when one is found; a table of contents
+    may leave pages out (or be a site menu), so following it is opt-in
+
+    With more than one worker, the main browser only discovers the page order and the pages are printed in parallel
+    by render_pages. With compose, the pages of a static book are stitched into one document once the page order is
+    known and printed in a few large parts instead (see compose_pages)
+
+    print_options are extra Page.printToPDF options, see make_print_options
+
+    With prefetch, pages found by gemini or a learned rule are loaded directly from their url when they have one, and
+    the likely next page is loaded in a second tab while the current one prints (see Prefetcher)
+
+    Progress is checkpointed to output_dir after every page; with resume, a previous run of the same book continues
+    from its last valid page instead of starting over
+
+    With keep_alive, the browser stays warm for the next conversion (see get_driver and release_driver)
+
+    confirm asks whether the table of contents is correct before converting; turn it off for unattended runs
+
+    Every stage is timed into report (by default a RunReport logging to events.jsonl in output_dir), which is
+    summarized in run_report.json at the end; profile additionally profiles the run into profile.prof
+
+    Returns the path of the converted book; raises ConversionError when the book can't be converted, leaving the
+    checkpoint behind for a resumed run
     """
-    print(f"Converting {url} to pdf")
-    driver = initialize_driver()
-    # original_width = driver.get_window_size()["width"]
-    # original_height = driver.get_window_size()["height"]
-    driver.get(url)
-    # Experimental; set_content_height to the maximum possible height to remove scrollbars
-    set_content(driver)
+    os.makedirs(output_dir, exist_ok=True)
+    if report is None:
+        report = RunReport(EVENTS.format(output_dir), append=resume)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    driver = None
+    try:
+        print(f"Converting {url} to pdf")
+        with stage(report, "browser", warm=keep_alive and warm_driver is not None) as event:
+            driver = get_driver(keep_alive)
+        print(f"Browser ready for {title} in {event['seconds']:.2f} seconds")
+        return _convert(
+            driver,
+            url=url,
+            output_dir=output_dir,
+            title=title,
+            rule_threshold=rule_threshold,
+            debug=debug,
+            workers=workers,
+            navigation=navigation,
+            print_options=print_options,
+            resume=resume,
+            confirm=confirm,
+            report=report,
+            compose=compose,
+            prefetch=prefetch,
+        )
+    finally:
+        # A warm browser stays open for the next conversion even when this one failed
+        if driver is not None and not keep_alive:
+            quit_driver(driver)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(PROFILE.format(output_dir))
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        print_summary(report.close(RUN_REPORT.format(output_dir)))
+
+
+def _convert(
+    driver,
+    *,
+    url,
+    output_dir,
+    title,
+    rule_threshold,
+    debug,
+    workers,
+    navigation,
+    print_options,
+    resume,
+    confirm,
+    report,
+    compose,
+    prefetch,
+):
+    # Pages are only printed during discovery when nothing else prints them afterwards
+    deferred = workers > 1 or compose
+    checkpoint = load_checkpoint(output_dir, url, title) if resume else None
 
     # Initialize filesystem
     pdf = "{}/part_{}.pdf"
-    png = "{}/part_{}.png"
-    pdfs = []
-    urls = []
-    features = []
-    screenshot = png.format(output_dir, 0)
-    save_screenshot(driver, screenshot)
-    home = PIL.Image.open(screenshot)
-    save_pdf(driver, pdf.format(output_dir, 0))
-    pdfs.append(pdf.format(output_dir, 0))
-
-    print(f"Title: {title}")
-
-    table_of_contents = table_of_contents_ai.generate_content(
-        ["**CURRENT HTML**\n" + driver.page_source, PIL.Image.open(screenshot)]
-    ).text
+    # Screenshots only touch the disk when debugging
+    image = "{}/part_{}." + SCREENSHOT_FORMAT.lower()
+    if checkpoint is not None:
+        home_url = checkpoint["home_url"]
+        pdfs = checkpoint["pdfs"]
+        urls = checkpoint["urls"]
+        features = checkpoint["features"]
+        toc_pages = checkpoint["toc_pages"]
+        table_of_contents = checkpoint["table_of_contents"]
+        llm_calls = checkpoint["llm_calls"]
+        page_fingerprints = checkpoint["page_fingerprints"]
+        fingerprints = set(page_fingerprints) - {None}
+        page_num = len(urls) + 1
+        print(f"Resuming {title} at page {page_num}")
+        with stage(report, "load", page=page_num):
+            driver.get(urls[-1] if urls else home_url)
+        set_content(driver, report=report)
+        screenshot = capture_screenshot(
+            driver,
+            debug_path=image.format(output_dir, page_num - 1) if debug else None,
+            report=report,
+        )
+    else:
+        # original_width = driver.get_window_size()["width"]
+        # original_height = driver.get_window_size()["height"]
+        with stage(report, "load", page=1):
+            driver.get(url)
+        home_url = driver.current_url
+        # Experimental; set_content_height to the maximum possible height to remove scrollbars
+        set_content(driver, report=report)
+        pdfs = []
+        urls = []
+        features = []
+        llm_calls = 0
+        page_num = 1
+        # Content fingerprints of the pages we have, to recognize a page under another url; page_fingerprints holds
+        # the fingerprint of the home page and of each page of urls (None where it wasn't loaded), so it can be
+        # trimmed along with them
+        page_fingerprints = [page_fingerprint(driver)]
+        fingerprints = set(page_fingerprints) - {None}
+        screenshot = capture_screenshot(
+            driver,
+            debug_path=image.format(output_dir, 0) if debug else None,
+            report=report,
+        )
+        if not deferred:
+            save_pdf(
+                driver,
+                pdf.format(output_dir, 0),
+                print_options=print_options,
+                report=report,
+            )
+            pdfs.append(pdf.format(output_dir, 0))
+
+        print(f"Title: {title}")
+
+        # Books with a linked table of contents can be scheduled up front without asking gemini for every page
+        toc_pages = []
+        if navigation != "llm":
+            with stage(report, "toc_links") as event:
+                toc_pages = extract_toc_pages(driver)
+                event["links"] = len(toc_pages)
+            if len(toc_pages) >= TOC_MIN_PAGES:
+                toc_pages = repair_toc_pages(toc_pages, report)
+            else:
+                print(
+                    f"Found {len(toc_pages)} table of contents links; navigating with gemini"
+                )
+                toc_pages = []
+            if navigation == "toc" and not toc_pages:
+                raise ConversionError(f"No linked table of contents found for {title}")
+        toc_contents = None
+        if toc_pages:
+            table_of_contents = format_toc(toc_pages)
+        else:
+            toc_contents = ["**CURRENT HTML**\n" + driver.page_source, screenshot]
+            table_of_contents = scheduler.generate(
+                table_of_contents_ai, toc_contents, report
+            ).text
+
+        if confirm:
+            table_of_contents_input = input(
+                table_of_contents + "\nIs this table of contents correct? y/n: "
+            )
+            if table_of_contents_input.lower() != "y":
+                # Ask gemini again next time instead of replaying the rejected answer
+                if toc_contents is not None and scheduler.cache is not None:
+                    scheduler.cache.discard(table_of_contents_ai, toc_contents)
+                raise ConversionError(f"Table of contents of {title} was incorrect")
+        else:
+            print(table_of_contents)
+
+    def checkpoint_progress():
+        save_checkpoint(
+            output_dir,
+            {
+                "url": url,
+                "title": title,
+                "home_url": home_url,
+                "pdfs": pdfs,
+                "urls": urls,
+                "features": features,
+                "toc_pages": toc_pages,
+                "table_of_contents": table_of_contents,
+                "llm_calls": llm_calls,
+                "page_fingerprints": page_fingerprints,
+            },
+        )
 
-    table_of_contents_input = input(
-        table_of_contents + "\nIs this table of contents correct? y/n: "
-    )
-    if table_of_contents_input.lower() != "y":
-        print("Table of contents was incorrect!")
-        quit(driver, home, writer)
+    checkpoint_progress()
 
     # Retrieve the HTML, one page at a time
     element_features = {}
-    page_num = 1
-    while True:
-        element_features = get_next_page(
-            driver,
-            driver.page_source,
-            PIL.Image.open(screenshot),
-            features,
-            urls,
-            table_of_contents,
-        )
-        if element_features is None:
-            break
-        # Convert the page to a pdf
-        save_pdf(driver, pdf.format(output_dir, page_num))
-        # Save the pdf
-        pdfs.append(pdf.format(output_dir, page_num))
-        # Save the screenshot
-        save_screenshot(driver, png.format(output_dir, page_num))
-        screenshot = png.format(output_dir, page_num)
-        # Remove previous screenshot that aren't the home page to save storage
-        if page_num - 1 > 0:
-            os.remove(png.format(output_dir, page_num - 1))
+    for page in toc_pages[len(urls) :]:
+        urls.append(page["url"])
+        page_fingerprints.append(None)
         page_num += 1
-        print(f"Saved page {page_num}")
-        urls.append(driver.current_url)
-        features.append(element_features)
-    os.remove(png.format(output_dir, page_num - 1))
-    writer = PdfWriter()
-    for pdf in pdfs:
-        writer.append(pdf)
-    writer.write(f"{output_dir}/{title}.pdf")
+        if not deferred:
+            with stage(report, "load", page=page_num):
+                driver.get(page["url"])
+            set_content(driver, report=report)
+            fingerprint = page_fingerprint(driver)
+            page_fingerprints[-1] = fingerprint
+            if fingerprint is not None and fingerprint in fingerprints:
+                # Skipped pages keep their place so pdfs stays aligned with urls
+                print(f"Skipping page {page_num}; its content was already saved")
+                pdfs.append(None)
+                checkpoint_progress()
+                continue
+            if fingerprint is not None:
+                fingerprints.add(fingerprint)
+            save_pdf(
+                driver,
+                pdf.format(output_dir, page_num - 1),
+                print_options=print_options,
+                report=report,
+            )
+            pdfs.append(pdf.format(output_dir, page_num - 1))
+        print(f"{'Scheduled' if deferred else 'Saved'} page {page_num}")
+        checkpoint_progress()
+    # Visited pages are tracked here rather than left to gemini
+    visited = {normalize_url(visited_url) for visited_url in [home_url] + urls}
+    # The page the browser is on has been printed (the home page, or the last page of a resumed run)
+    printed = True
+    # Consecutive navigations that ended on a page we already have
+    duplicates = 0
+    prefetcher = Prefetcher(driver, report) if prefetch else None
+    # Gemini decides on the next page while the current page prints, so each page costs about the longer of the two
+    # instead of their sum
+    with ThreadPoolExecutor(max_workers=1) as navigator:
+        while not toc_pages:
+            decision = None
+            # Once the navigation element is stable, click it directly instead of asking gemini
+            rule = learn_rule(features, rule_threshold)
+            if rule is None:
+                page = extract_navigation_candidates(driver, visited, report)
+                decision = navigator.submit(
+                    ask_next_page,
+                    page,
+                    screenshot,
+                    features,
+                    urls,
+                    table_of_contents,
+                    report,
+                )
+            if prefetcher is not None:
+                # The likely next page loads in the background while this one prints and gemini decides
+                next_url = predict_next_url(
+                    driver, page if rule is None else None, rule, features, visited
+                )
+                if next_url is not None:
+                    prefetcher.start(next_url)
+            if not printed:
+                # Convert the page to a pdf
+                save_pdf(
+                    driver,
+                    pdf.format(output_dir, page_num - 1),
+                    print_options=print_options,
+                    report=report,
+                )
+                # Save the pdf
+                pdfs.append(pdf.format(output_dir, page_num - 1))
+                print(f"Saved page {page_num}")
+                checkpoint_progress()
+                printed = True
+            element_features = None
+            if rule is not None:
+                element_features = replay_rule(
+                    driver, rule, visited, report, prefetcher
+                )
+                if element_features is None:
+                    page = extract_navigation_candidates(driver, visited, report)
+                    decision = navigator.submit(
+                        ask_next_page,
+                        page,
+                        screenshot,
+                        features,
+                        urls,
+                        table_of_contents,
+                        report,
+                    )
+            if element_features is None:
+                llm_calls += 1
+                element_features, contents = decision.result()
+                element_features = follow_next_page(
+                    driver,
+                    element_features,
+                    page["candidates"],
+                    report,
+                    page["urls"] if prefetch else None,
+                    prefetcher,
+                    contents,
+                )
+            if element_features is None:
+                break
+            # Skip pages we already have, whether under the same url or another one, before anything is rendered
+            current_url = normalize_url(driver.current_url)
+            fingerprint = page_fingerprint(driver)
+            if current_url in visited or (
+                fingerprint is not None and fingerprint in fingerprints
+            ):
+                duplicates += 1
+                visited.add(current_url)
+                print(f"Skipping {driver.current_url}; its content was already saved")
+                if duplicates >= LOOP_LIMIT:
+                    print(f"Navigation returned to saved pages {duplicates} times in a row; stopping")
+                    break
+                # Go back and ask again; the duplicate is now visited so it won't be offered again
+                report.record("duplicate", url=driver.current_url)
+                go_back(driver, urls[-1] if urls else home_url)
+                set_content(driver, report=report)
+                continue
+            duplicates = 0
+            if fingerprint is not None:
+                fingerprints.add(fingerprint)
+            # Capture the screenshot for the next navigation decision
+            screenshot = capture_screenshot(
+                driver,
+                debug_path=image.format(output_dir, page_num) if debug else None,
+                report=report,
+            )
+            page_num += 1
+            urls.append(driver.current_url)
+            page_fingerprints.append(fingerprint)
+            visited.add(normalize_url(driver.current_url))
+            features.append(element_features)
+            # Pages are printed after the next decision has been requested; with several workers or compose they
+            # are printed by render_pages or compose_pages once the order is known
+            printed = deferred
+            if printed:
+                print(f"Found page {page_num}")
+                checkpoint_progress()
+    if prefetcher is not None:
+        prefetcher.cancel()
+    print(f"Made {llm_calls} navigation calls to gemini for {page_num} pages")
+    composed = None
+    if compose:
+        composed = compose_pages(
+            driver, [home_url] + urls, output_dir, print_options, report=report
+        )
+        if composed is None:
+            print("Printing the pages one at a time instead")
+    if composed is not None:
+        # Bookmarks come from the headings chrome outlines in the composed parts
+        pdfs = composed
+        outline = None
+    else:
+        if deferred:
+            pdfs = render_pages(
+                [home_url] + urls,
+                output_dir,
+                workers,
+                print_options,
+                skip_valid=resume,
+                report=report,
+                fingerprints=page_fingerprints,
+                progress=checkpoint_progress,
+            )
+        # Bookmarks follow the table of contents when there is one, and otherwise the titles of the pages
+        if toc_pages:
+            outline = [(title, 0)] + [
+                (page["text"], page["depth"]) for page in toc_pages
+            ]
+        else:
+            outline = [(title, 0)] + [(None, 0)] * len(urls)
+        # Duplicate pages were skipped
+        outline = [entry for pdf, entry in zip(pdfs, outline) if pdf is not None]
+        pdfs = [pdf for pdf in pdfs if pdf is not None]
+    assemble_pdf(pdfs, f"{output_dir}/{title}.pdf", outline, report)
     # Remove temporary files
     for pdf in pdfs:
         os.remove(pdf)
-    os.remove(png.format(output_dir, 0))
-    quit(driver, home, writer)
+    os.remove(CHECKPOINT.format(output_dir))
+    print(f"Saved {output_dir}/{title}.pdf")
+    return f"{output_dir}/{title}.pdf"
 
 
-def get_next_page(
-    driver, html, previous_page, previous_features, urls, table_of_contents
+def convert_batch(
+    books,
+    concurrency=BATCH_BOOKS,
+    browsers=BATCH_BROWSERS,
+    attempts=BATCH_ATTEMPTS,
+    **options,
 ):
     """
-    Navigates to the next content-filled page in the book and returns it's html
+    Converts many books at once and returns a result for every book, in order, instead of stopping at a failure
+
+    books are dicts with the url, output_dir and title of a book, plus any convert options for that book alone;
+    options apply to every book. Up to `concurrency` books run at once, within `browsers` open browsers (a book
+    needs one, or workers + 1 when it prints in parallel) and the available memory, and all of them share the gemini
+    rate limits of scheduler. Books writing to the same output_dir run one after another
+
+    A failed book is retried up to `attempts` times in total, resuming from its checkpoint; ConversionErrors,
+    TypeErrors and ValueErrors (bad options) are not retried. Books with keys convert doesn't take are rejected with
+    a ValueError before anything runs. Each result has the url, title, output_dir, the path of the pdf in "output"
+    (None on failure), the "error" of the last attempt, the number of "attempts" and the "seconds" spent
     """
-    try:
-        element_features = json.loads(
-            gemini.generate_content(
-                [
-                    "### TABLE OF CONTENTS\n"
-                    + table_of_contents
-                    + "### VISITED PAGES\n"
-                    + str(urls)
-                    + "\n"
-                    + "### PREVIOUS FEATURES\n"
-                    + str(previous_features)
-                    + "\n"
-                    + "### CURRENT HTML\n"
-                    + html,
-                    previous_page,
-                ]
+    for book in books:
+        check_book(book)
+    gate = BrowserGate(browsers)
+    directory_locks = {book["output_dir"]: threading.Lock() for book in books}
+
+    def convert_book(book):
+        book_options = {**options, **book}
+        workers = book_options.get("workers", WORKERS)
+        if workers > 1:
+            # The browser discovering the page order stays open while the workers print
+            workers = book_options["workers"] = max(1, min(workers, browsers - 1))
+        # Composed books fall back to printing with workers when a page can't be fetched
+        book_browsers = 1 if workers <= 1 and not book_options.get("compose") else workers + 1
+        result = {
+            "url": book["url"],
+            "title": book["title"],
+            "output_dir": book["output_dir"],
+            "output": None,
+            "error": None,
+            "attempts": 0,
+        }
+        start = time.monotonic()
+        with directory_locks[book["output_dir"]]:
+            for attempt in range(attempts):
+                if attempt:
+                    print(f"Retrying {book['title']} in {BATCH_RETRY_DELAY} seconds")
+                    time.sleep(BATCH_RETRY_DELAY)
+                result["attempts"] += 1
+                try:
+                    with gate.reserve(book_browsers):
+                        # Warm browsers can't be shared between books, and nobody is there to confirm
+                        result["output"] = convert(
+                            **dict(
+                                book_options,
+                                resume=book_options.get("resume", False) or attempt > 0,
+                                keep_alive=False,
+                                confirm=False,
+                            )
+                        )
+                    result["error"] = None
+                    break
+                except ConversionError as e:
+                    result["error"] = str(e)
+                    break
+                except (TypeError, ValueError) as e:
+                    # Bad options fail the same way every time
+                    result["error"] = repr(e)
+                    print(f"Converting {book['title']} failed: {e!r}")
+                    break
+                except Exception as e:
+                    result["error"] = repr(e)
+                    print(f"Converting {book['title']} failed: {e!r}")
+        result["seconds"] = round(time.monotonic() - start, 3)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return list(executor.map(convert_book, books))
+
+
+def load_manifest(path):
+    """
+    Loads the books of a batch from a JSON file holding a list of {"url", "output_dir", "title"} objects
+    """
+    with open(path) as file:
+        books = json.load(file)
+    for book in books:
+        check_book(book)
+    return books
+
+
+def check_book(book):
+    """
+    Raises ValueError when a book of a batch is missing its url, output_dir or title, or has keys convert doesn't
+    take
+    """
+    missing = {"url", "output_dir", "title"} - set(book)
+    if missing:
+        raise ValueError(f"Book {book} is missing {', '.join(sorted(missing))}")
+    unknown = set(book) - set(inspect.signature(convert).parameters)
+    if unknown:
+        raise ValueError(f"Book {book} has unknown keys {', '.join(sorted(unknown))}")
+
+
+def assemble_pdf(parts, output_path, outline=None, report=None):
+    """
+    Joins the part pdfs into output_path, reading one part at a time, and returns the size of the book in bytes
+
+    Identical objects shared between parts (fonts, background images and logos printed with every page) are stored
+    once and content streams are compressed. outline has a (title, depth) for every part, added as nested bookmarks;
+    parts without a title are bookmarked with the title chrome printed into them. Without an outline, the parts keep
+    the bookmarks they were printed with
+    """
+    with stage(report, "merge", parts=len(parts)) as event:
+        writer = PdfWriter()
+        # The last bookmark at each depth, to nest the following ones under
+        parents = []
+        part_bytes = 0
+        for index, part in enumerate(parts):
+            part_bytes += os.path.getsize(part)
+            first_page = len(writer.pages)
+            # Appending copies the part into the writer, so its file can be closed right away
+            with open(part, "rb") as file:
+                reader = PdfReader(file)
+                writer.append(reader, import_outline=outline is None)
+                printed_title = reader.metadata.title if reader.metadata else None
+            if outline is None or len(writer.pages) == first_page:
+                continue
+            part_title, depth = outline[index]
+            del parents[depth:]
+            parents.append(
+                writer.add_outline_item(
+                    part_title or printed_title or f"Page {index + 1}",
+                    first_page,
+                    parent=parents[-1] if parents else None,
+                )
             )
-            .text.replace("```json\n", "")
-            .replace("```", "")
-            .strip()
+        for page in writer.pages:
+            page.compress_content_streams()
+        # Only newer versions of pypdf can merge identical objects
+        if hasattr(writer, "compress_identical_objects"):
+            writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+        writer.write(output_path)
+        writer.close()
+        output_bytes = os.path.getsize(output_path)
+        event.update(part_bytes=part_bytes, output_bytes=output_bytes)
+    if part_bytes:
+        print(
+            f"Merged {len(parts)} parts of {part_bytes} bytes into {output_bytes} bytes "
+            f"({1 - output_bytes / part_bytes:.0%} smaller)"
+        )
+    return output_bytes
+
+
+def save_checkpoint(output_dir, state):
+    """
+    Atomically replaces the checkpoint in output_dir with state, so an interrupted write never corrupts it
+    """
+    checkpoint = CHECKPOINT.format(output_dir)
+    with open(checkpoint + ".tmp", "w") as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+def load_checkpoint(output_dir, url, title):
+    """
+    Loads the checkpoint of a previous conversion of the same book from output_dir
+
+    Parts that are missing or unreadable are dropped along with every page after them; returns None if there is
+    nothing to resume
+    """
+    checkpoint = CHECKPOINT.format(output_dir)
+    if not os.path.exists(checkpoint):
+        print(f"No checkpoint found in {output_dir}; starting over")
+        return None
+    with open(checkpoint) as file:
+        state = json.load(file)
+    if state["url"] != url or state["title"] != title:
+        print(f"Checkpoint in {output_dir} is for {state['title']}; starting over")
+        return None
+    valid = 0
+    # Parts skipped as duplicates are None
+    while valid < len(state["pdfs"]) and (
+        state["pdfs"][valid] is None or valid_pdf(state["pdfs"][valid])
+    ):
+        valid += 1
+    if valid < len(state["pdfs"]):
+        print(f"Part {state['pdfs'][valid]} is invalid; resuming before it")
+        if valid == 0:
+            return None
+        # pdfs[0] is the home page and pdfs[i] the page reached through urls[i - 1]
+        state["pdfs"] = state["pdfs"][:valid]
+        state["urls"] = state["urls"][: valid - 1]
+        state["features"] = state["features"][: valid - 1]
+    # Fingerprints of dropped pages would make them look like duplicates when they are visited again
+    state["page_fingerprints"] = state.get("page_fingerprints", [])[: len(state["urls"]) + 1]
+    return state
+
+
+def page_fingerprint(driver):
+    """
+    Returns a fingerprint of the main text of the current page, so the same content is recognized under any url, or
+    None when the page has too little text to tell it apart
+    """
+    return driver.execute_script(PAGE_FINGERPRINT_SCRIPT, FINGERPRINT_MIN_TEXT)
+
+
+def valid_pdf(path):
+    """
+    Returns whether path is a readable pdf with at least one page
+    """
+    try:
+        return len(PdfReader(path).pages) > 0
+    except Exception:
+        return False
+
+
+def normalize_url(url):
+    """
+    Normalizes a url so the same page is recognized under different spellings (fragments, case, trailing slashes)
+    """
+    parts = urlsplit(urldefrag(url)[0])
+    path = parts.path
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/")
+    return urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), path or "/", parts.query, "")
+    )
+
+
+def extract_toc_pages(driver):
+    """
+    Extracts the ordered, deduplicated pages linked from the largest same-origin link list on the current page
+
+    Each page is a dict with its "url" (as linked, without a fragment), link "text" and nesting "depth" in the
+    table of contents; urls are only normalized to recognize the same page linked twice, since loading a normalized
+    url (e.g. without its trailing slash) can break the page
+    """
+    links = driver.execute_script(TOC_LINKS_SCRIPT)
+    home = normalize_url(driver.current_url)
+    pages = []
+    seen = {home}
+    for link in links:
+        # Links to sections of a page already in the list (fragments) collapse into that page
+        if normalize_url(link["href"]) in seen:
+            continue
+        seen.add(normalize_url(link["href"]))
+        pages.append(
+            {
+                "url": urldefrag(link["href"])[0],
+                "text": link["text"],
+                "depth": link["depth"],
+            }
+        )
+    return pages
+
+
+def format_toc(toc_pages):
+    """
+    Formats table of contents pages as the indented text table of contents used in prompts
+    """
+    return "".join(
+        "    " * page["depth"] + f"{index}. {page['text']}\n"
+        for index, page in enumerate(toc_pages)
+    )
+
+
+def repair_toc_pages(toc_pages, report=None):
+    """
+    Asks gemini to confirm the extracted table of contents, dropping links that aren't pages of the book and fixing
+    the reading order if needed; the extracted pages are kept as they are if the answer can't be used
+    """
+    listing = "".join(
+        "    " * page["depth"] + f"{index}. {page['text']} ({page['url']})\n"
+        for index, page in enumerate(toc_pages)
+    )
+    try:
+        response = scheduler.generate_json(
+            toc_links_ai, ["### EXTRACTED PAGES\n" + listing], report
         )
+        order = [int(index) for index in response["order"]]
     except Exception as e:
-        # Gemini API exception; delay 60 seconds and then try again
-        time.sleep(60)
-        element_features = json.loads(
-            gemini.generate_content(
-                [
-                    "### TABLE OF CONTENTS\n"
-                    + table_of_contents
-                    + "### VISITED PAGES\n"
-                    + str(urls)
-                    + "\n"
-                    + "### PREVIOUS FEATURES\n"
-                    + str(previous_features)
-                    + "\n"
-                    + "### CURRENT HTML\n"
-                    + html,
-                    previous_page,
-                ]
+        print(f"Could not confirm the table of contents with gemini: {e}")
+        return toc_pages
+    print(response.get("log", ""))
+    repaired = []
+    for index in order:
+        if 0 <= index < len(toc_pages) and toc_pages[index] not in repaired:
+            repaired.append(toc_pages[index])
+    if not repaired:
+        return toc_pages
+    if len(repaired) != len(toc_pages) or repaired != toc_pages:
+        print(f"Gemini repaired the table of contents ({len(toc_pages)} -> {len(repaired)} pages)")
+    return repaired
+
+
+def compose_pages(
+    driver,
+    page_urls,
+    output_dir,
+    print_options=None,
+    batch_size=COMPOSE_BATCH_PAGES,
+    report=None,
+):
+    """
+    Prints page_urls as continuous documents of batch_size pages composed in the current tab, with one print call
+    per batch instead of one per page, and returns the paths of the printed parts
+
+    Pages are fetched as html rather than loaded, so this is meant for static books; content their scripts would
+    render is lost. Returns None when a page can't be fetched, so the pages can be printed one at a time instead.
+    The parts are printed with an outline of their headings
+    """
+    print_options = dict(print_options or {}, generateDocumentOutline=True)
+    parts = []
+    for first in range(0, len(page_urls), batch_size):
+        batch = page_urls[first : first + batch_size]
+        # The first page of the batch provides the head, and with it the book's styles
+        with stage(report, "load", page=first + 1):
+            driver.get(batch[0])
+        with stage(report, "compose", pages=len(batch)) as event:
+            driver.set_script_timeout(COMPOSE_TIMEOUT + 1)
+            result = driver.execute_async_script(
+                COMPOSE_SCRIPT, batch, first, COMPOSE_TIMEOUT * 1000
             )
-            .text.replace("```json\n", "")
-            .replace("```", "")
-            .strip()
+            event.update(result)
+        if "error" in result:
+            print(f"Could not compose pages {first + 1}-{first + len(batch)}: {result['error']}")
+            for part in parts:
+                os.remove(part)
+            return None
+        driver.execute_script(
+            PREPARE_PAGE_SCRIPT, FILTER_STYLE, ", ".join(REMOVED_SELECTORS)
         )
-    print(element_features)
+        output_path = f"{output_dir}/part_{first}.pdf"
+        save_pdf(driver, output_path, print_options=print_options, report=report)
+        parts.append(output_path)
+        print(f"Saved pages {first + 1}-{first + len(batch)} as one document")
+    return parts
+
+
+def render_pages(
+    page_urls,
+    output_dir,
+    workers=WORKERS,
+    print_options=None,
+    skip_valid=False,
+    report=None,
+    fingerprints=None,
+    progress=None,
+):
+    """
+    Prints page_urls to part files with a pool of worker browsers and returns the part paths in the original order
+
+    With skip_valid, parts already printed by an interrupted run are kept instead of being printed again
+
+    Each worker thread drives its own browser, so pages only reachable through javascript (without their own url)
+    should be converted with a single worker. fingerprints holds the content fingerprint of each page (None where
+    it isn't known yet, or the page has too little text to have one) and is filled in as pages load; of the pages
+    with the same fingerprint only the first is kept, and the others are returned as None. progress is called after
+    every page, e.g. to checkpoint the fingerprints
+    """
+    if fingerprints is None:
+        fingerprints = [None] * len(page_urls)
+    local = threading.local()
+    drivers = []
+    lock = threading.Lock()
+
+    def is_duplicate(index):
+        # Pages without a fingerprint are never duplicates
+        return fingerprints[index] is not None and fingerprints[index] in fingerprints[:index]
+
+    def render(index, page_url):
+        output_path = f"{output_dir}/part_{index}.pdf"
+        kept = skip_valid and valid_pdf(output_path)
+        # Kept parts only need loading when their fingerprint wasn't checkpointed
+        if not kept or fingerprints[index] is None:
+            if not hasattr(local, "driver"):
+                local.driver = initialize_driver()
+                with lock:
+                    drivers.append(local.driver)
+            with stage(report, "load", page=index + 1):
+                local.driver.get(page_url)
+            set_content(local.driver, report=report)
+            with lock:
+                fingerprints[index] = page_fingerprint(local.driver)
+        with lock:
+            duplicate = is_duplicate(index)
+        if duplicate:
+            print(f"Skipping page {index + 1}; its content comes earlier in the book")
+        elif not kept:
+            save_pdf(
+                local.driver, output_path, print_options=print_options, report=report
+            )
+            print(f"Saved page {index + 1}")
+        if progress is not None:
+            with lock:
+                progress()
+        return output_path if kept or not duplicate else None
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(render, range(len(page_urls)), page_urls))
+    finally:
+        for driver in drivers:
+            quit_driver(driver)
+    # Pages finish out of order, so a page may have been printed before an earlier copy of it was loaded
+    for index, part in enumerate(parts):
+        if part is not None and is_duplicate(index):
+            os.remove(part)
+            parts[index] = None
+    return parts
+
+
+def estimate_tokens(characters):
+    """
+    Rough token estimate for a prompt of the given length (gemini averages ~4 characters per token)
+    """
+    return characters // 4
+
+
+def extract_navigation_candidates(driver, visited=(), report=None):
+    """
+    Reduces the current page to a compact list of navigation candidates
+
+    Candidates linking to a normalized url in visited are dropped, so gemini can't pick a page we already have.
+    Returns a dict with the "candidates", their absolute "urls" by index, the page "title" and "url", the number of
+    "visited" candidates dropped and the "html_length" of the full page source the candidates replace in the prompt
+    """
+    with stage(report, "candidates"):
+        page = driver.execute_script(
+            NAVIGATION_CANDIDATES_SCRIPT, NAVIGATION_CANDIDATE_SELECTOR
+        )
+    candidates = []
+    # Absolute urls of the candidates, by index, kept out of the prompt
+    page["urls"] = {}
+    for candidate in page["candidates"]:
+        candidate_url = candidate.pop("url")
+        if candidate_url and normalize_url(candidate_url) in visited:
+            continue
+        candidates.append(candidate)
+        if candidate_url:
+            page["urls"][candidate["index"]] = candidate_url
+    page["visited"] = len(page["candidates"]) - len(candidates)
+    page["candidates"] = candidates
+    return page
+
+
+def find_candidate(driver, candidates, index):
+    """
+    Returns the element for the candidate index chosen by gemini, or None if the index is not a known candidate
+    """
+    try:
+        index = int(index)
+    except (TypeError, ValueError):
+        return None
+    if index not in [candidate["index"] for candidate in candidates]:
+        return None
+    return driver.execute_script(
+        "return document.querySelectorAll(arguments[0])[arguments[1]] || null;",
+        NAVIGATION_CANDIDATE_SELECTOR,
+        index,
+    )
+
+
+def build_xpath(element_features):
+    """
+    Builds the xpath matching the element described by element_features; returns None when every feature is "NONE"
+    """
     id = element_features["id"]
     tag = element_features["tag"]
     href = element_features["href"]
@@ -542,35 +2728,497 @@ def get_next_page(
         xpath += f'(. | descendant-or-self::text())[contains(normalize-space(.), "{text}")] and '
     if element_class != "NONE":
         xpath += f'contains(@class, "{element_class}") and '
-    xpath = xpath[:-5] + "]"
+    # A bare "//*[" has nothing to strip
+    if xpath.endswith("["):
+        return xpath[:-1]
+    return xpath[:-5] + "]"
+
+
+def learn_rule(previous_features, consecutive=RULE_THRESHOLD):
+    """
+    Returns a navigation rule once the last `consecutive` pages were reached through matching features, else None
+
+    Features are considered matching when "tag", "text", "class" and "id" agree; the href usually changes from page
+    to page, so it is only kept in the rule when it was identical every time
+    """
+    if consecutive < 1 or len(previous_features) < consecutive:
+        return None
+    recent = previous_features[-consecutive:]
+    rule = {}
+    for key in RULE_FEATURES:
+        values = {str(features.get(key, "NONE")) for features in recent}
+        if len(values) != 1:
+            return None
+        rule[key] = values.pop()
+    hrefs = {str(features.get("href", "NONE")) for features in recent}
+    rule["href"] = hrefs.pop() if len(hrefs) == 1 else "NONE"
+    # A rule made only of "NONE" (or of a bare tag) would match far too much
+    if all(rule[key] == "NONE" for key in ("text", "class", "id")):
+        return None
+    rule["log"] = f"Replayed rule learned from the last {consecutive} pages"
+    return rule
+
+
+def replay_rule(driver, rule, visited, report=None, prefetcher=None):
+    """
+    Follows the element matched by a learned rule without consulting gemini; with a prefetcher, an element with a
+    url is loaded from it directly (from the prefetcher's tab when it was prefetched) instead of being clicked
+
+    Returns the rule if it led to a new page, or None if the rule matched no element, elements leading to different
+    pages, or an already visited url (visited holds normalized urls), in which case the caller should fall back to
+    gemini
+    """
+    xpath = build_xpath(rule)
+    if xpath is None:
+        return None
+    with stage(report, "navigate", level="rule") as event:
+        element, href = find_rule_target(driver, xpath)
+        if element is None:
+            event["level"] = "rule failed"
+            return None
+        if href and normalize_url(href) in visited:
+            print(f"Learned rule leads to visited page {href}; asking gemini")
+            event["level"] = "rule failed"
+            return None
+        previous_url = driver.current_url
+        # Without a prefetcher, the element is clicked like any other
+        url = navigable_url(href, previous_url) if prefetcher is not None else None
+        if url is not None:
+            event["prefetched"] = open_url(driver, url, prefetcher) == "prefetched"
+        else:
+            element.click()
+        if normalize_url(driver.current_url) in visited:
+            print(f"Learned rule led to visited page {driver.current_url}; asking gemini")
+            go_back(driver, previous_url)
+            event["level"] = "rule failed"
+            return None
+    print(f"Replayed learned rule {xpath}")
+    set_content(driver, report=report)
+    return dict(rule)
+
+
+def find_rule_target(driver, xpath):
+    """
+    Returns the element matched by a rule's xpath and its href, or (None, None) when the rule can't be replayed
+
+    Books often repeat their navigation bar above and below the content, so several matches are fine as long as
+    they all link to the same page
+    """
+    elements = driver.find_elements(By.XPATH, xpath)
+    if not elements:
+        print("Learned rule matched no element; asking gemini")
+        return None, None
+    # Resolve every href in one round trip
+    hrefs = driver.execute_script(
+        "return arguments[0].map(function (element) { return element.href || null; });",
+        elements,
+    )
+    if len(elements) > 1 and (
+        None in hrefs or len({normalize_url(href) for href in hrefs}) != 1
+    ):
+        print(f"Learned rule matched {len(elements)} elements leading to different pages; asking gemini")
+        return None, None
+    return elements[0], hrefs[0]
+
+
+def predict_next_url(driver, page, rule, previous_features, visited):
+    """
+    Guesses the url the next navigation will load, for prefetching: the element matched by the learned rule, else
+    the candidate of page matching the features that led to the last page, else a rel="next" candidate
+
+    Returns None without a guess, or when the guess is visited or can't be loaded directly
+    """
+    url = None
+    if rule is not None:
+        url = find_rule_target(driver, build_xpath(rule))[1]
+    elif page is not None:
+        last = previous_features[-1] if previous_features else {}
+        matching = [
+            candidate
+            for candidate in page["candidates"]
+            if last
+            and all(
+                str(candidate[key]) == str(last.get(key, "NONE"))
+                for key in RULE_FEATURES
+            )
+        ]
+        following = [
+            candidate for candidate in page["candidates"] if candidate["rel"] == "next"
+        ]
+        for candidate in matching + following:
+            if candidate["index"] in page["urls"]:
+                url = page["urls"][candidate["index"]]
+                break
+    url = navigable_url(url, driver.current_url)
+    if url is None or normalize_url(url) in visited:
+        return None
+    return url
+
+
+def navigable_url(url, current_url):
+    """
+    Returns url if loading it directly navigates to another page (an http(s) url that isn't just a fragment of
+    current_url), else None
+    """
+    if not url or urlsplit(url).scheme not in ("http", "https"):
+        return None
+    if normalize_url(url) == normalize_url(current_url):
+        return None
+    return url
+
+
+def open_url(driver, url, prefetcher=None):
+    """
+    Navigates to url, swapping to prefetcher's tab when it already loaded the page; returns how the page was opened
+    """
+    if prefetcher is not None and prefetcher.take(url):
+        return "prefetched"
+    driver.get(url)
+    return "href"
+
+
+def go_back(driver, previous_url):
+    """
+    Returns to previous_url, through the history when it has the page (a prefetched tab has no history to go back
+    through)
+    """
+    driver.back()
+    if normalize_url(driver.current_url) != normalize_url(previous_url):
+        driver.get(previous_url)
+
+
+def ask_next_page(
+    page, previous_page, previous_features, urls, table_of_contents, report=None
+):
+    """
+    Asks gemini which navigation candidate of page (see extract_navigation_candidates) leads to the next page and
+    returns the features of that element, along with the prompt so a wrong answer can be dropped from the cache
+
+    This doesn't touch the browser, so it can run while the current page is being printed
+    """
+    candidates_json = json.dumps(page["candidates"], ensure_ascii=False)
+    saved_tokens = estimate_tokens(page["html_length"]) - estimate_tokens(
+        len(candidates_json)
+    )
+    print(
+        f"Prompting with {len(page['candidates'])} navigation candidates; saved ~{saved_tokens} tokens"
+    )
+    # Everything but the table of contents is bounded, so the prompt stays the same size however far into the book
+    prompt = (
+        "### TABLE OF CONTENTS\n"
+        + table_of_contents
+        + "\n### PROGRESS\n"
+        + summarize_progress(page, urls)
+        + "\n### PREVIOUS FEATURES\n"
+        + json.dumps(summarize_features(previous_features), ensure_ascii=False)
+        + "\n### NAVIGATION CANDIDATES\n"
+        + candidates_json
+    )
+    if report is not None:
+        report.record(
+            "prompt",
+            prompt_bytes=len(prompt.encode()),
+            saved_tokens=saved_tokens,
+            candidates=len(page["candidates"]),
+        )
+    contents = [prompt, previous_page]
+    element_features = scheduler.generate_json(gemini, contents, report)
+    print(element_features)
+    return element_features, contents
+
+
+def summarize_progress(page, urls):
+    """
+    Summarizes how far into the book the conversion is, in place of the full list of visited pages
+    """
+    recent = "\n".join(f"* {visited_url}" for visited_url in urls[-PROMPT_RECENT_PAGES:])
+    return (
+        f"{len(urls) + 1} pages visited so far; the current page is {page['title']!r} ({page['url']}).\n"
+        f"{page['visited']} candidates leading to visited pages were removed.\n"
+        f"Most recently visited pages:\n{recent or '* NONE'}\n"
+    )
+
+
+def summarize_features(previous_features, window=PROMPT_FEATURE_WINDOW):
+    """
+    Returns the distinct features of the last `window` pages, each with the number of pages it led to, without the
+    logs and candidate indexes that only applied to the page they were chosen on
+
+    Consecutive features are merged when RULE_FEATURES agree, like in learn_rule; the href of a "next" link changes
+    on every page, so the merged entry keeps the latest one
+    """
+    summary = []
+    for features in previous_features[-window:]:
+        stable = {key: features.get(key, "NONE") for key in ("tag", "href", "text", "class", "id")}
+        if summary and all(
+            str(summary[-1][key]) == str(stable[key]) for key in RULE_FEATURES
+        ):
+            summary[-1]["href"] = stable["href"]
+            summary[-1]["pages"] += 1
+        else:
+            summary.append(dict(stable, pages=1))
+    return summary
+
+
+def follow_next_page(
+    driver,
+    element_features,
+    candidates,
+    report=None,
+    candidate_urls=None,
+    prefetcher=None,
+    contents=None,
+):
+    """
+    Follows the element described by element_features and returns them, or None at the end of the book
+
+    When the element can't be found, the cached answer to contents (the prompt it came from) is dropped
+    """
+    with stage(report, "navigate") as event:
+        element_features, event["level"] = click_next_page(
+            driver, element_features, candidates, candidate_urls, prefetcher
+        )
+    if event["level"] == "not found" and contents is not None and scheduler.cache is not None:
+        scheduler.cache.discard(gemini, contents)
+    if element_features is not None:
+        set_content(driver, report=report)
+    return element_features
+
+
+def click_next_page(
+    driver, element_features, candidates, candidate_urls=None, prefetcher=None
+):
+    """
+    Clicks the element described by element_features, returning them (or None) along with how the element was found
+
+    A picked candidate with a url of its own (in candidate_urls) is loaded directly, from prefetcher's tab when it
+    was prefetched, without looking the element up
+    """
+    if build_xpath(element_features) is not None:
+        try:
+            index = int(element_features.get("candidate"))
+        except (TypeError, ValueError):
+            index = None
+        if index in [candidate["index"] for candidate in candidates]:
+            url = navigable_url((candidate_urls or {}).get(index), driver.current_url)
+            if url is not None:
+                return element_features, open_url(driver, url, prefetcher)
+        # Prefer the candidate the model picked; the xpath guesses below are only a fallback
+        element = find_candidate(driver, candidates, element_features.get("candidate"))
+        if element is not None:
+            if element.tag_name == "link":
+                # <link rel="next"> isn't rendered, so it can't be clicked; follow its href instead
+                driver.get(element.get_attribute("href"))
+                return element_features, "link"
+            element.click()
+            return element_features, "candidate"
+    xpath = build_xpath(element_features)
+    if xpath is None:
+        return None, "end"
+    href = element_features["href"]
+    text = element_features["text"]
+    element_class = element_features["class"]
     print(xpath)
+    level = "xpath"
     try:
         driver.find_element(By.XPATH, xpath).click()
     except NoSuchElementException:
         # Remove the class definition in the hopes of matching without
         # In case gemini hallucinates class incorrectly
         try:
+            level = "xpath without class"
             xpath = xpath.replace(f' and contains(@class, "{element_class}")', "")
             driver.find_element(By.XPATH, xpath).click()
         except NoSuchElementException:
             try:
                 # Try pruning numbers from the text input
                 # In case invalid text is the issue
+                level = "xpath without digits"
                 text_no_nums = "".join([i for i in text if not i.isdigit()])
                 xpath = xpath.replace(text, text_no_nums)
                 driver.find_element(By.XPATH, xpath).click()
             except NoSuchElementException:
                 try:
                     # Try pruning the href from the xpath in case the link is invalid
+                    level = "xpath without href"
                     xpath = xpath.replace(f'contains(@href, "{href}") and ', "")
                     driver.find_element(By.XPATH, xpath).click()
                 except NoSuchElementException:
                     print("Element not found; final book will not be complete")
-                    return None
-    set_content(driver)
-    previous_page.close()
-    return element_features
+                    return None, "not found"
+    return element_features, level
 
 
 if __name__ == "__main__":
-    convert(URL, OUTPUT_DIR, TITLE)
+    parser = argparse.ArgumentParser(
+        description="Converts html books to pdfs using gemini to find the next page"
+    )
+    # Note that the URL should be the main page containing the table of contents
+    parser.add_argument(
+        "url", nargs="?", help="url of table of contents/home page of html book"
+    )
+    parser.add_argument("output_dir", nargs="?")
+    parser.add_argument("title", nargs="?", help="title of book")
+    parser.add_argument(
+        "--batch",
+        help="convert every book of a JSON manifest of {url, output_dir, title} objects instead",
+    )
+    parser.add_argument(
+        "--books",
+        type=int,
+        default=BATCH_BOOKS,
+        help="books of a batch converted at once",
+    )
+    parser.add_argument(
+        "--browsers",
+        type=int,
+        default=BATCH_BROWSERS,
+        help="browsers open at once across the books of a batch",
+    )
+    parser.add_argument(
+        "--attempts",
+        type=int,
+        default=BATCH_ATTEMPTS,
+        help="attempts per book of a batch",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of browsers printing pages in parallel once the page order is known",
+    )
+    parser.add_argument(
+        "--compose",
+        action="store_true",
+        help="print static books as one continuous document instead of page by page",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="click through to each page instead of loading it from its url and preloading the next one",
+    )
+    parser.add_argument(
+        "--rule-threshold",
+        type=int,
+        default=RULE_THRESHOLD,
+        help="consecutive matching pages before navigation replays a learned rule (0 disables)",
+    )
+    parser.add_argument(
+        "--navigation",
+        choices=["auto", "toc", "llm"],
+        default="llm",
+        help="take the page order from gemini (llm), from the linked table of contents (toc), or toc when found (auto)",
+    )
+    parser.add_argument(
+        "--paper-size",
+        help=f"print on a fixed paper size ({', '.join(PAPER_SIZES)} or <width>x<height> in inches)",
+    )
+    parser.add_argument(
+        "--page-ranges", help="only print these pages of each part, e.g. 1-5"
+    )
+    parser.add_argument(
+        "--block",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="also block requests for urls matching this pattern (* matches anything); can be repeated",
+    )
+    parser.add_argument(
+        "--block-type",
+        action="append",
+        default=[],
+        choices=sorted(RESOURCE_TYPE_URLS),
+        help=f"also block this resource type (blocked by default: {', '.join(BLOCKED_RESOURCE_TYPES)})",
+    )
+    parser.add_argument(
+        "--no-block",
+        action="store_true",
+        help="don't block ads, analytics, embeds and other non-content requests",
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=GEMINI_RPM, help="gemini requests per minute"
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=GEMINI_TPM, help="gemini tokens per minute"
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="only use cached gemini responses, failing instead of calling gemini",
+    )
+    parser.add_argument(
+        "--no-gemini-cache",
+        action="store_true",
+        help="always call gemini instead of reusing cached responses",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted conversion from the checkpoint in output_dir",
+    )
+    parser.add_argument(
+        "--yes",
+        action="store_true",
+        help="don't ask whether the table of contents is correct",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile the conversion into output_dir/profile.prof",
+    )
+    parser.add_argument(
+        "--debug", action="store_true", help="keep screenshots in output_dir"
+    )
+    args = parser.parse_args()
+    if args.batch is None and None in (args.url, args.output_dir, args.title):
+        parser.error("url, output_dir and title are required without --batch")
+    if args.replay and args.no_gemini_cache:
+        parser.error("--replay needs the gemini cache")
+    scheduler = RequestScheduler(
+        rpm=args.rpm,
+        tpm=args.tpm,
+        cache=(
+            None
+            if args.no_gemini_cache or GEMINI_CACHE_DIR is None
+            else ResponseCache(replay_only=args.replay)
+        ),
+    )
+    if args.no_block:
+        BLOCKED_URLS = ()
+        BLOCKED_RESOURCE_TYPES = ()
+    BLOCKED_URLS = BLOCKED_URLS + tuple(args.block)
+    BLOCKED_RESOURCE_TYPES = BLOCKED_RESOURCE_TYPES + tuple(args.block_type)
+    options = dict(
+        rule_threshold=args.rule_threshold,
+        debug=args.debug,
+        workers=args.workers,
+        navigation=args.navigation,
+        print_options=make_print_options(args.paper_size, args.page_ranges),
+        resume=args.resume,
+        compose=args.compose,
+        prefetch=not args.no_prefetch,
+    )
+    if args.batch is not None:
+        results = convert_batch(
+            load_manifest(args.batch),
+            concurrency=args.books,
+            browsers=args.browsers,
+            attempts=args.attempts,
+            **options,
+        )
+        for result in results:
+            outcome = result["output"] or f"failed ({result['error']})"
+            print(f"{result['title']}: {outcome} after {result['attempts']} attempts")
+        sys.exit(any(result["output"] is None for result in results))
+    try:
+        convert(
+            args.url,
+            args.output_dir,
+            args.title,
+            confirm=not args.yes,
+            profile=args.profile,
+            **options,
+        )
+    except ConversionError as e:
+        print(e)
+        sys.exit(1)
@@ -1,13 +1,16 @@
-from convert import convert
+from convert import convert, release_driver
 
 # Proof of concept conversion of two html-books
 BOOK_ONE = "https://artint.info/3e/html/ArtInt3e.html"
 BOOK_TWO = "https://www.programming-books.io/essential/algorithms/"
 OUTPUT_DIR = "test_output"
 
+# Both books share one warm browser
 convert(
     BOOK_ONE,
     OUTPUT_DIR,
     "Artificial Intelligence: Foundations of Computational Agents, 3rd Edition",
+    keep_alive=True,
 )
-convert(BOOK_TWO, OUTPUT_DIR, "Essential Algorithms")
+convert(BOOK_TWO, OUTPUT_DIR, "Essential Algorithms", keep_alive=True)
+release_driver()